@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import time
+
+
+class Admission:
+    def __init__(self, max_games=None, queue_size=16, queue_timeout=5.0):
+        # at most max_games games run at once; up to queue_size more clients wait (for at most
+        # queue_timeout seconds) for one to finish, and anyone beyond that is told the server is busy
+        # straight away, so admitted games keep their engine time when the server is overloaded
+        self.max_games = max_games
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _has_room(self):
+        return self.max_games is None or self.active < self.max_games
+
+    def acquire(self):
+        # returns True if the game may start; release() must be called when it ends
+        with self._condition:
+            if self._has_room() and not self.waiting:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                admitted = self._condition.wait_for(self._has_room, self.queue_timeout)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                self.timed_out += 1
+                return False
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        return {"active": self.active, "waiting": self.waiting, "admitted": self.admitted, "rejected": self.rejected,
+                "timed_out": self.timed_out}
+
+
+class AsyncAdmission(Admission):
+    def __init__(self, max_games=None, queue_size=16, queue_timeout=5.0):
+        # asyncio version; only ever used from the event loop
+        super().__init__(max_games, queue_size, queue_timeout)
+        self._condition = None
+
+    async def acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            if self._has_room() and not self.waiting:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._condition.wait_for(self._has_room), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                return False
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    async def release(self):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class Heartbeat:
+    def __init__(self, interval, move_timeout):
+        # decides what to do about a silent client without doing any I/O: ping it after `interval` seconds
+        # of silence, give up when a ping goes unanswered for another interval, and end the game when it
+        # has not moved for move_timeout seconds. interval is None for clients without heartbeats
+        self.interval = interval
+        self.move_timeout = move_timeout
+        self.last_seen = time.monotonic()
+        self.pinged = None
+        self.move_started = None
+        self.expired = None  # "timeout" or "silent" once the client has lost the game or the connection
+
+    def start_move(self):
+        self.move_started = time.monotonic()
+
+    def stop_move(self):
+        self.move_started = None
+
+    def seen(self):
+        self.last_seen = time.monotonic()
+        self.pinged = None
+
+    def check(self):
+        # returns True when a ping should be sent now; sets expired when the client has run out of time
+        now = time.monotonic()
+        if self.move_started is not None and self.move_timeout and now - self.move_started >= self.move_timeout:
+            self.expired = "timeout"
+        elif self.interval and self.pinged is not None and now - self.pinged >= self.interval:
+            self.expired = "silent"
+        elif self.interval and self.pinged is None and now - self.last_seen >= self.interval:
+            self.pinged = now
+            return True
+        return False
+
+    def next_check(self):
+        # seconds until check() has something new to say, or None to wait indefinitely
+        deadlines = []
+        if self.move_started is not None and self.move_timeout:
+            deadlines.append(self.move_started + self.move_timeout)
+        if self.interval:
+            deadlines.append((self.pinged if self.pinged is not None else self.last_seen) + self.interval)
+        return max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import shlex
+import sys
+import threading
+import time
+
+import chess
+import chess.engine
+import chess.pgn
+
+from engine_pool import EnginePool
+
+
+def read_tasks(paths, first_ply=0):
+    # yields (source, [boards]) lazily: one task per FEN line, or one task per PGN game covering every
+    # position in it, so positions of the same game go to the same engine and share its hash table
+    for path in paths:
+        f = sys.stdin if path == "-" else open(path)
+        try:
+            if path.endswith(".pgn"):
+                number = 0
+                while True:
+                    game = chess.pgn.read_game(f)
+                    if game is None:
+                        break
+                    number += 1
+                    board = game.board()
+                    boards = []
+                    for move in game.mainline_moves():
+                        if board.ply() >= first_ply:
+                            boards.append(board.copy(stack=False))
+                        board.push(move)
+                    if board.ply() >= first_ply and not board.is_game_over():
+                        boards.append(board.copy(stack=False))
+                    yield f"{path}#{number}", boards
+            else:
+                for number, line in enumerate(f, 1):
+                    fen = line.split(";")[0].strip()  # also accepts EPD lines with trailing opcodes
+                    if fen and not fen.startswith("#"):
+                        try:
+                            board = chess.Board(fen)
+                        except ValueError:
+                            print(f"Skipping invalid FEN at {path}:{number}", file=sys.stderr)
+                            continue
+                        yield f"{path}:{number}", [board]
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def score_json(score):
+    # scores are from white's point of view, like a PGN annotation
+    white = score.white()
+    return {"mate": white.mate()} if white.is_mate() else {"cp": white.score()}
+
+
+class BatchAnalyzer:
+    def __init__(self, pool, limit, output=sys.stdout):
+        # one worker thread per engine; workers pull tasks from a shared iterator, so only as many
+        # games as there are engines are held in memory however large the input is
+        self.pool = pool
+        self.limit = limit
+        self.output = output
+        self._tasks_lock = threading.Lock()
+        self._output_lock = threading.Lock()
+        self.positions = 0
+        self.errors = 0
+        self.started = time.monotonic()
+
+    def row(self, board, source, info=None, error=None):
+        row = {"source": source, "ply": board.ply(), "fen": board.fen()}
+        if error:
+            row["error"] = error
+            return row
+        pv = info.get("pv", [])
+        row.update(best=pv[0].uci() if pv else None, pv=[move.uci() for move in pv], depth=info.get("depth"),
+                   nodes=info.get("nodes"))
+        if "score" in info:
+            row.update(score_json(info["score"]))
+        return row
+
+    def emit(self, row):
+        line = json.dumps(row)
+        with self._output_lock:
+            self.output.write(line + "\n")
+            self.positions += 1
+
+    def worker(self, tasks):
+        while True:
+            with self._tasks_lock:
+                task = next(tasks, None)
+            if task is None:
+                return
+            self.analyse_task(*task)
+
+    def analyse_task(self, source, boards):
+        # the whole task runs on one engine checkout; if the engine crashes the pool restarts it and the
+        # position is tried once more before it is reported as an error
+        position = 0
+        retried = False
+        while position < len(boards):
+            try:
+                with self.pool.checkout() as (engine, _):
+                    while position < len(boards):
+                        board = boards[position]
+                        self.emit(self.row(board, source, engine.analyse(board, self.limit, game=source)))
+                        position += 1
+                        retried = False
+            except (chess.engine.EngineError, chess.engine.EngineTerminatedError) as e:
+                if isinstance(e, chess.engine.EngineTerminatedError) and not retried:
+                    retried = True
+                    continue
+                with self._output_lock:
+                    self.errors += 1
+                self.emit(self.row(boards[position], source, error=str(e)))
+                position += 1
+                retried = False
+
+    def run(self, tasks, workers, progress_interval=10.0):
+        tasks = iter(tasks)
+        threads = [threading.Thread(target=self.worker, args=(tasks,), daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(progress_interval)
+                if thread.is_alive():
+                    self.report()
+        self.report()
+
+    def report(self):
+        with self._output_lock:
+            self.output.flush()
+        elapsed = time.monotonic() - self.started
+        print(f"{self.positions} positions in {elapsed:.0f}s ({self.positions / elapsed:.1f}/s), "
+              f"{self.errors} errors", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse FEN/EPD files or PGN games on a pool of engines. "
+                                                 "Writes one JSON line per position as results come in.")
+    parser.add_argument("inputs", nargs="+", help=".pgn files (every position of every game), other files are "
+                                                  "read as one FEN per line; - reads FENs from stdin")
+    parser.add_argument("--engines", type=int, default=None, help="engine processes (default: CPU count)")
+    parser.add_argument("--engine-command", default="stockfish")
+    parser.add_argument("--depth", type=int, default=None)
+    parser.add_argument("--nodes", type=int, default=None)
+    parser.add_argument("--time", type=float, default=None, help="seconds per position")
+    parser.add_argument("--first-ply", type=int, default=0, help="skip the opening plies of PGN games")
+    parser.add_argument("--output", default=None, help="write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    if args.depth is None and args.nodes is None and args.time is None:
+        args.depth = 12
+    limit = chess.engine.Limit(depth=args.depth, nodes=args.nodes, time=args.time)
+    engines = args.engines or os.cpu_count() or 1
+    pool = EnginePool(engines, shlex.split(args.engine_command))
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        BatchAnalyzer(pool, limit, output).run(read_tasks(args.inputs, args.first_ply), engines)
+    except KeyboardInterrupt:
+        print("Stopped.", file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
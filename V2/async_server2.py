@@ -0,0 +1,315 @@
+import asyncio
+import os
+import time
+import chess
+import chess.engine
+
+from admission import AsyncAdmission
+from engine_pool import AsyncEnginePool
+from game_server import BotGame, GameServer
+from matchmaking import RelayGame
+from ponder import AsyncPonderer
+from protocol2 import (MSG_CONTROL, CTRL_ACCEPTED, CTRL_BUSY, CTRL_PING, CTRL_PONG, encode_control, encode_hello,
+                       encode_text, read_frame)
+from session import AsyncResumeRegistry
+from spectators import AsyncSpectatorHub
+
+
+class AsyncChessServer(GameServer):
+    def __init__(self, host, port, engines=None, engine_command="stockfish", cache_size=10000, cache_file=None,
+                 book=None, pgn_log=None, archive=None, ponder=False, reuse_port=False, metrics_port=None,
+                 debug=False, spectator_buffer=4096, handshake_timeout=10.0, move_timeout=600.0,
+                 heartbeat_interval=30.0, max_games=None, queue_size=16, queue_timeout=5.0, backlog=128,
+                 engine_wait=None, resume_grace=60.0):
+        # one event loop serves every connection; games are coroutines instead of threads
+        super().__init__(host, port, AsyncEnginePool(engines or os.cpu_count() or 1, engine_command),
+                         AsyncAdmission(max_games, queue_size, queue_timeout), AsyncResumeRegistry(resume_grace),
+                         AsyncSpectatorHub(spectator_buffer), cache_size=cache_size, cache_file=cache_file, book=book,
+                         pgn_log=pgn_log, archive=archive, ponder=ponder, metrics_port=metrics_port, debug=debug,
+                         handshake_timeout=handshake_timeout, move_timeout=move_timeout,
+                         heartbeat_interval=heartbeat_interval, backlog=backlog, engine_wait=engine_wait)
+        self.reuse_port = reuse_port
+
+    async def engine_move(self, board, limit):
+        # returns the engine's move and the reply it expects, which is what pondering searches on
+        cached = self.cached_move(board, limit)
+        if cached:
+            return cached
+        try:
+            result, waited = await self.engine_pool.play(board, limit, timeout=self.engine_wait)
+        except asyncio.TimeoutError:
+            return await self.lite_move(board, limit, "saturated")
+        except chess.engine.EngineError as e:
+            print("Engine failed:", e)
+            return await self.lite_move(board, limit, "no_engine")
+        return self.remember(board, limit, result, waited)
+
+    async def lite_move(self, board, limit, reason):
+        # the search is plain Python, so it runs on the default executor to keep the event loop serving
+        self.metrics.builtin_moves.inc(label_value=reason)
+        result = await asyncio.get_running_loop().run_in_executor(None, self.lite_engine.play, board, limit)
+        return result.move, result.ponder
+
+    async def server_reply(self, board, limit, ponderer=None, level="hard"):
+        # same order as ChessServer.server_reply
+        move = self.book_move(board)
+        if move:
+            if ponderer:
+                await ponderer.cancel()
+            return move, None
+        if ponderer:
+            best = await ponderer.resolve(board.peek() if board.move_stack else None, limit)
+            if best:
+                return self.remember(board, limit, best)
+        reason = self.builtin_reason(level)
+        if reason:
+            return await self.lite_move(board, limit, reason)
+        return await self.engine_move(board, limit)
+
+    async def send(self, writer, data):
+        writer.write(data)
+        await writer.drain()
+
+    async def receive(self, reader):
+        return await asyncio.wait_for(read_frame(reader), self.handshake_timeout)
+
+    async def handshake(self, reader, writer):
+        # same exchange as ChessServer.handshake, but a slow client only blocks itself
+        await self.send(writer, encode_hello())
+        version = self.read_version(await self.receive(reader))
+        if version is None:
+            await self.send(writer, encode_text("Unsupported protocol version."))
+            return None
+        opponent = self.read_opponent(self.read_text(await self.receive(reader)))
+        if opponent is None:
+            await self.send(writer, encode_text("Invalid opponent choice."))
+            return None
+        await self.send(writer, encode_control(CTRL_ACCEPTED))
+        choice = self.read_choice(*opponent, self.read_text(await self.receive(reader)), version)
+        if choice is None:
+            await self.send(writer, encode_text("Invalid color choice."))
+        return choice
+
+    async def receive_move_frame(self, reader, writer, heartbeat):
+        # same as ChessServer.receive_move_frame; the read stays pending across pings so a frame is never
+        # cut in half by a timeout
+        heartbeat.start_move()
+        read = asyncio.ensure_future(read_frame(reader))
+        try:
+            while True:
+                try:
+                    if heartbeat.check():
+                        await self.send(writer, encode_control(CTRL_PING))
+                except OSError:
+                    return None
+                if heartbeat.expired:
+                    return None
+                done, _ = await asyncio.wait({read}, timeout=heartbeat.next_check())
+                if not done:
+                    continue
+                if read.exception():
+                    return None  # reset by the client
+                frame = read.result()
+                heartbeat.seen()
+                if frame != (MSG_CONTROL, bytes([CTRL_PONG])):
+                    return frame
+                read = asyncio.ensure_future(read_frame(reader))
+        finally:
+            read.cancel()
+
+    async def handle_client(self, reader, writer, client_color, version, level="hard"):
+        async def send(data):
+            # a failed write is noticed by the next read, which is where a dropped client gets to resume
+            if data:
+                try:
+                    await self.send(writer, data)
+                except OSError:
+                    pass
+
+        metrics = self.metrics
+        game = BotGame(self, client_color, version, level)
+        ponderer = AsyncPonderer(self.engine_pool) if self.ponder and self.engine_pool and level == "hard" else None
+        finished = None  # set once the game is done with a resumed connection, see resume_game
+        try:
+            data, board = game.opening()
+            await send(data)
+            if board:
+                with metrics.engine_seconds.time():
+                    server_move, expected_reply = await self.server_reply(board, game.first_move_limit, level=level)
+                data = game.on_reply(board, server_move)
+                with metrics.send_seconds.time():
+                    await send(data)
+                if ponderer:
+                    await ponderer.start(board, expected_reply, game.reply_limit)
+
+            while not game.over:
+                board = None  # only the compact session is kept while waiting for the client
+                with metrics.recv_seconds.time():
+                    frame = await self.receive_move_frame(reader, writer, game.heartbeat)
+                if frame is None and game.may_resume():
+                    print("Client disconnected, holding the game for it to resume.")
+                    writer.close()
+                    if finished:
+                        finished.set_result(None)
+                        finished = None
+                    if ponderer:
+                        await ponderer.cancel()
+                    resumed = await self.resumable.wait(game.token)
+                    if resumed:
+                        (reader, writer, finished), ply = resumed
+                        await send(game.on_resume(ply))
+                        continue
+                if frame is None:
+                    await send(game.on_lost())
+                    break
+                data, board = game.on_frame(frame)
+                await send(data)
+                if board is None:
+                    continue
+                with metrics.engine_seconds.time():
+                    server_move, expected_reply = await self.server_reply(board, game.reply_limit, ponderer, level)
+                data = game.on_reply(board, server_move)
+                with metrics.send_seconds.time():
+                    await send(data)
+                if ponderer and not game.over:
+                    await ponderer.start(board, expected_reply, game.reply_limit)
+        finally:
+            if finished:
+                finished.set_result(None)
+            if ponderer:
+                await ponderer.cancel()
+            game.finish()
+
+    def waiting_alive(self, player):
+        reader, _, finished, _ = player
+        if not reader.at_eof():
+            return True
+        if not finished.done():
+            finished.set_result(None)
+        return False
+
+    async def match_player(self, reader, writer, client_color, version):
+        # a player is (reader, writer, future, protocol version); the future resolves when that player's game
+        # is over, which is what keeps the first player's connection open while the second one runs the relay
+        player = (reader, writer, asyncio.get_running_loop().create_future(), version)
+        pair = self.match_queue.join(player, client_color, alive=self.waiting_alive)
+        if pair is None:
+            await self.send(writer, encode_text("Waiting for an opponent."))
+            try:
+                await player[2]
+            finally:
+                self.match_queue.leave(player)
+            return
+        try:
+            await self.relay_game(*pair)
+        finally:
+            for _, _, finished, _ in pair:
+                if not finished.done():
+                    finished.set_result(None)
+
+    async def relay_game(self, white, black):
+        game = RelayGame(self.legal_moves)
+        started = time.time()
+        game_id, heartbeats = self.open_relay(game, (white[3], black[3]))
+        players = {chess.WHITE: white, chess.BLACK: black}
+
+        def send(outputs):
+            for target, data in outputs:
+                try:
+                    players[target][1].write(data)
+                except (OSError, RuntimeError):
+                    pass  # the transport is closed; the read on that side reports the disconnect
+
+        send(self.opponent_found())
+        reads = {asyncio.ensure_future(read_frame(player[0])): color for color, player in players.items()}
+        try:
+            while not game.over:
+                done, _ = await asyncio.wait(reads, timeout=self.relay_timeout(heartbeats),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    color = reads.pop(task)
+                    frame = None if task.exception() else task.result()
+                    send(self.relay_frame(game, game_id, heartbeats, color, frame))
+                    if game.over:
+                        break
+                    reads[asyncio.ensure_future(read_frame(players[color][0]))] = color
+                send(self.relay_heartbeats(game, heartbeats))
+        finally:
+            for task in reads:
+                task.cancel()
+            self.finish_relay(game, game_id, started)
+
+    async def watch_game(self, reader, writer, game_id):
+        if not (game_id and game_id.isdigit() and await self.spectators.watch(reader, writer, int(game_id))):
+            await self.send(writer, self.spectators.listing())
+
+    async def resume_game(self, reader, writer, request):
+        # same as ChessServer.resume_game; the connection stays open until the game is done with it
+        token, _, ply = (request or "").partition(":")
+        finished = asyncio.get_running_loop().create_future()
+        if ply.isdigit() and self.resumable.resume(token, (reader, writer, finished), int(ply)):
+            await finished
+            return
+        await self.send(writer, encode_text("Unknown or expired session."))
+
+    async def on_connect(self, reader, writer):
+        try:
+            choice = await self.handshake(reader, writer)
+            if choice is None:
+                return
+            opponent, color, version, level = choice
+            if opponent == "watch":
+                await self.watch_game(reader, writer, color)
+            elif opponent == "resume":
+                await self.resume_game(reader, writer, color)
+            elif opponent == "human":
+                await self.send(writer, encode_control(CTRL_ACCEPTED))
+                await self.match_player(reader, writer, color, version)
+            elif not await self.admission.acquire():
+                self.metrics.busy_rejections.inc()
+                await self.send(writer, encode_control(CTRL_BUSY))
+            else:
+                try:
+                    await self.send(writer, encode_control(CTRL_ACCEPTED))
+                    await self.handle_client(reader, writer, color, version, level)
+                finally:
+                    await self.admission.release()
+        except asyncio.TimeoutError:
+            print("Client timed out during handshake.")
+        except Exception as e:
+            print("Exception occurred:", e)
+        finally:
+            writer.close()
+
+    async def serve(self):
+        try:
+            await self.engine_pool.start()
+        except (OSError, chess.engine.EngineError) as e:
+            print(f"Could not start the engine ({e}), every game uses the built-in engine.")
+            await self.engine_pool.close()
+            self.engine_pool = None
+        server = await asyncio.start_server(self.on_connect, self.host, self.port,
+                                            reuse_port=self.reuse_port or None, backlog=self.backlog)
+        print(f"Server listening on {self.host}:{self.port} (asyncio)")
+        if self.metrics_server:
+            self.metrics_server.start()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if self.metrics_server:
+                self.metrics_server.stop()
+            if self.engine_cache and self.engine_cache.path:
+                self.engine_cache.save()
+            if self.opening_book:
+                self.opening_book.close()
+            if self.archive:
+                self.archive.close()
+            if self.engine_pool:
+                await self.engine_pool.close()
+
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("Server shutting down.")
@@ -0,0 +1,68 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import loadgen
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def bench_server(mode_args, args):
+    # start server2.py with the fake engine on a free port, load it, and stop it again
+    port = free_port()
+    engine_command = f"{sys.executable} {os.path.join(HERE, 'fake_engine.py')} --delay {args.engine_delay}"
+    command = [sys.executable, os.path.join(HERE, "server2.py"), "--port", str(port), "--engines", str(args.engines),
+               "--engine-command", engine_command, "--cache-size", "0"] + mode_args
+    server = subprocess.Popen(command, cwd=HERE, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        return loadgen.run("localhost", port, args.players, args.games, args.moves, args.think_time, args.seed)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the load generator against each server mode.")
+    parser.add_argument("--players", type=int, default=20)
+    parser.add_argument("--games", type=int, default=2)
+    parser.add_argument("--moves", type=int, default=30)
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--engines", type=int, default=2)
+    parser.add_argument("--engine-delay", type=float, default=0.01, help="simulated search time of the fake engine")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.jsonl", help="results are appended as JSON lines")
+    args = parser.parse_args()
+
+    modes = {"threaded": [], "asyncio": ["--asyncio"]}
+    for label, mode_args in modes.items():
+        result = bench_server(mode_args, args)
+        result.update(label=label, engines=args.engines, engine_delay=args.engine_delay, timestamp=time.time())
+        print(json.dumps(result))
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
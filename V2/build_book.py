@@ -0,0 +1,31 @@
+import argparse
+
+import chess.pgn
+
+from opening_book import add_game, read_book, write_book
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or extend a Polyglot opening book from PGN games.")
+    parser.add_argument("book", help="book file to create or extend")
+    parser.add_argument("pgn", nargs="+", help="PGN files, e.g. the server's --pgn-log")
+    parser.add_argument("--max-ply", type=int, default=30, help="only use the first plies of each game")
+    args = parser.parse_args()
+
+    entries = read_book(args.book)
+    print(f"Loaded {len(entries)} entries from {args.book}")
+    games = 0
+    for path in args.pgn:
+        with open(path) as f:
+            while True:
+                game = chess.pgn.read_game(f)
+                if game is None:
+                    break
+                add_game(entries, game, args.max_ply)
+                games += 1
+    write_book(args.book, entries)
+    print(f"Added {games} games, book now has {sum(1 for weight, _ in entries.values() if weight)} entries")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 import tkinter as tk
 from PIL import Image, ImageTk
-import socket
-import threading
 import chess
 
+from client_io import ServerConnection
+from legal_moves import LegalMoveCache
+from protocol2 import (MSG_MOVE, MSG_SNAPSHOT, MSG_TEXT, CTRL_RESIGN, DIFFICULTIES, decode_move, describe,
+                       encode_control, encode_move)
+
 
 class ChessClient:
     def __init__(self):
@@ -19,6 +22,8 @@ class ChessClient:
         self.client_button = tk.Button(self.choice_frame, text="Play Against Human", command=self.start_client_game)
         self.client_button.pack(side=tk.RIGHT)
 
+        self.connection = None
+
     def start_bot_game(self):
         self.choice_frame.destroy()
         self.start_game("bot")
@@ -41,6 +46,13 @@ class ChessClient:
         self.black_button = tk.Button(self.root, text="Black", command=lambda: self.on_button_click("black"))
         self.black_button.pack()
 
+        self.difficulty = tk.StringVar()
+        self.difficulty.set("hard")
+        self.difficulty_menu = None
+        if opponent_type == "bot":
+            self.difficulty_menu = tk.OptionMenu(self.root, self.difficulty, *DIFFICULTIES)
+            self.difficulty_menu.pack()
+
         self.submit_button = tk.Button(self.root, text="Submit", command=self.connect_to_server)
         self.submit_button.pack()
 
@@ -51,51 +63,64 @@ class ChessClient:
         self.white_button.destroy()
         self.black_button.destroy()
         self.submit_button.destroy()
+        if self.difficulty_menu:
+            self.difficulty_menu.destroy()
 
         host = 'localhost'
         port = 5555
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.connect((host, port))
-
-        acknowledgment = self.server_socket.recv(1024).decode()
-        if acknowledgment != "Ready":
-            print("Server did not acknowledge.")
-            self.root.quit()
+        # the connection and handshake run in the background; on_connection_events hears how they went
+        self.status_label = tk.Label(self.root, text="Connecting...")
+        self.status_label.pack()
+        opponent = f"bot:{self.difficulty.get()}" if self.opponent_type == "bot" else self.opponent_type
+        self.connection = ServerConnection(host, port, opponent, self.color_choice.get())
+        self.connection.handler = self.on_connection_events
+        self.connection.poll(self.root)
+
+    def on_connection_events(self, events):
+        kind, detail = events[0]
+        if kind == "failed":
+            print(detail)
+            self.status_label.config(text=detail)
             return
+        self.status_label.destroy()
+        self.gui = ChessGUI(self.root, self.connection, self.color_choice.get())
+        if events[1:]:
+            self.gui.on_events(events[1:])
 
-        self.server_socket.send(self.opponent_type.encode())
 
-        if self.opponent_type == "human":
-            acknowledgment = self.server_socket.recv(1024).decode()
-            if acknowledgment != "Accepted":
-                print("Server did not accept the opponent type.")
-                self.root.quit()
-                return
+# resized piece images shared by every board in the process, keyed by (piece symbol, square size)
+PIECE_IMAGES = {}
 
-        client_color = self.color_choice.get()
-        self.server_socket.send(client_color.encode())
 
-        self.gui = ChessGUI(self.root, self.server_socket, client_color)
-        self.root.mainloop()
+def piece_image(symbol, size):
+    key = (symbol, size)
+    if key not in PIECE_IMAGES:
+        folder = "whitePieces" if symbol.isupper() else "blackPieces"
+        image = Image.open(f"../{folder}/{symbol}.png").resize((size, size), resample=Image.BILINEAR)
+        PIECE_IMAGES[key] = ImageTk.PhotoImage(image)
+    return PIECE_IMAGES[key]
 
 
 class ChessGUI:
-    def __init__(self, root, server_socket, client_color):
+    def __init__(self, root, connection, client_color, square_size=50):
         self.root = root
-        self.server_socket = server_socket
+        self.connection = connection
         self.client_color = client_color
+        self.square_size = square_size
         self.root.title("Chess Game")
 
         self.board = chess.Board()
-        self.board_canvas = tk.Canvas(self.root, width=400, height=400)
+        self.legal_moves = LegalMoveCache(1000)
+        self.board_canvas = tk.Canvas(self.root, width=8 * square_size, height=8 * square_size)
         self.board_canvas.pack()
 
+        self.piece_items = {}  # square -> (canvas item, piece symbol) for what is currently drawn
         self.load_images()
         self.draw_board()
 
         self.board_canvas.bind("<Button-1>", self.on_square_click)
 
-        threading.Thread(target=self.receive_moves).start()
+        self.connection.handler = self.on_events
 
         self.resign_button = tk.Button(self.root, text="Resign", command=self.resign)
         self.resign_button.pack()
@@ -103,72 +128,165 @@ class ChessGUI:
     def load_images(self):
         self.piece_images = {}
         for piece_type in ['r', 'n', 'b', 'q', 'k', 'p']:
-            white_image = Image.open(f"../whitePieces/{piece_type.upper()}.png")
-            white_image = white_image.resize((50, 50), resample=Image.BILINEAR)
-            self.piece_images[piece_type.upper()] = ImageTk.PhotoImage(white_image)
+            self.piece_images[piece_type.upper()] = piece_image(piece_type.upper(), self.square_size)
+            self.piece_images[piece_type] = piece_image(piece_type, self.square_size)
+
+    def square_origin(self, square):
+        return chess.square_file(square) * self.square_size, (7 - chess.square_rank(square)) * self.square_size
 
-            black_image = Image.open(f"../blackPieces/{piece_type}.png")
-            black_image = black_image.resize((50, 50), resample=Image.BILINEAR)
-            self.piece_images[piece_type] = ImageTk.PhotoImage(black_image)
+    def square_center(self, square):
+        x0, y0 = self.square_origin(square)
+        return x0 + self.square_size // 2, y0 + self.square_size // 2
 
     def draw_board(self):
-        self.board_canvas.delete("all")
-        square_size = 50
+        # the squares and highlight outlines are created once; after that only update_board runs
+        square_size = self.square_size
         colors = ["white", "gray"]
         for row in range(8):
             for col in range(8):
                 color = colors[(row + col) % 2]
                 x0, y0 = col * square_size, row * square_size
                 x1, y1 = x0 + square_size, y0 + square_size
-                self.board_canvas.create_rectangle(x0, y0, x1, y1, fill=color, outline="")
-                piece = self.board.piece_at(chess.square(col, 7 - row))
-                if piece:
-                    piece_symbol = piece.symbol()
-                    image = self.piece_images.get(piece_symbol)
-                    if image:
-                        self.board_canvas.create_image((x0 + x1) // 2, (y0 + y1) // 2, image=image)
+                self.board_canvas.create_rectangle(x0, y0, x1, y1, fill=color, outline="", tags="square")
+        self.last_move_items = [
+            self.board_canvas.create_rectangle(0, 0, 0, 0, outline="gold", width=3, state="hidden")
+            for _ in range(2)
+        ]
+        self.selection_item = self.board_canvas.create_rectangle(0, 0, 0, 0, outline="blue", width=3, state="hidden")
+        self.update_board()
+
+    def update_board(self):
+        # touch only the squares whose piece changed since the last redraw
+        changed = {}
+        for square in set(self.piece_items) | set(self.board.piece_map()):
+            piece = self.board.piece_at(square)
+            symbol = piece.symbol() if piece else None
+            drawn = self.piece_items.get(square)
+            if (drawn[1] if drawn else None) != symbol:
+                changed[square] = symbol
+
+        # pieces leaving a square are kept around so a piece arriving elsewhere can reuse the item
+        vacated = {}
+        for square in changed:
+            if square in self.piece_items:
+                item, symbol = self.piece_items.pop(square)
+                vacated.setdefault(symbol, []).append(item)
+        for square, symbol in changed.items():
+            if symbol is None:
+                continue
+            if vacated.get(symbol):
+                item = vacated[symbol].pop()
+                self.board_canvas.coords(item, *self.square_center(square))
+            else:
+                item = self.board_canvas.create_image(*self.square_center(square), image=self.piece_images[symbol],
+                                                      tags="piece")
+            self.piece_items[square] = (item, symbol)
+        for items in vacated.values():
+            for item in items:
+                self.board_canvas.delete(item)
+
+        self.highlight_last_move()
+
+    def highlight_last_move(self):
+        if not self.board.move_stack:
+            return
+        move = self.board.peek()
+        for item, square in zip(self.last_move_items, (move.from_square, move.to_square)):
+            x0, y0 = self.square_origin(square)
+            self.board_canvas.coords(item, x0 + 1, y0 + 1, x0 + self.square_size - 1, y0 + self.square_size - 1)
+            self.board_canvas.itemconfigure(item, state="normal")
+        self.board_canvas.tag_raise("piece")
+
+    def highlight_selection(self, square):
+        if square is None:
+            self.board_canvas.itemconfigure(self.selection_item, state="hidden")
+            return
+        x0, y0 = self.square_origin(square)
+        self.board_canvas.coords(self.selection_item, x0 + 1, y0 + 1, x0 + self.square_size - 1,
+                                 y0 + self.square_size - 1)
+        self.board_canvas.itemconfigure(self.selection_item, state="normal")
+        self.board_canvas.tag_raise("piece")
 
     def on_square_click(self, event):
-        col = event.x // 50
-        row = 7 - (event.y // 50)
+        col = event.x // self.square_size
+        row = 7 - (event.y // self.square_size)
         square = chess.square(col, row)
         piece = self.board.piece_at(square)
         if piece and piece.color == (chess.WHITE if self.client_color == "white" else chess.BLACK):
             self.selected_square = square
+            self.highlight_selection(square)
         elif hasattr(self, 'selected_square'):
-            move = chess.Move(self.selected_square, square)
-            if move in self.board.legal_moves:
-                self.board.push(move)
-                self.draw_board()
-                move_str = move.uci()
-                print("Sending move:", move_str)
-                try:
-                    self.server_socket.send(move_str.encode())
-                except BrokenPipeError:
-                    print("Server connection closed.")
-                    self.root.quit()
+            moves = [move for move in self.legal_moves.moves_from(self.board, self.selected_square)
+                     if move.to_square == square]
+            if len(moves) > 1:
+                self.choose_promotion(moves, event)
+            elif moves:
+                self.play_move(moves[0])
             delattr(self, 'selected_square')
-
-    def receive_moves(self):
-        while True:
-            data = self.server_socket.recv(1024)
-            if not data:
+            self.highlight_selection(None)
+
+    def choose_promotion(self, moves, event):
+        # a pawn reaching the last rank has one move per piece it can become; ask which one
+        menu = tk.Menu(self.root, tearoff=0)
+        for move in sorted(moves, key=lambda move: move.promotion, reverse=True):
+            menu.add_command(label=chess.piece_name(move.promotion).capitalize(),
+                             command=lambda move=move: self.play_move(move))
+        menu.tk_popup(event.x_root, event.y_root)
+
+    def play_move(self, move):
+        self.board.push(move)
+        self.connection.ply = self.board.ply()
+        self.update_board()
+        print("Sending move:", move.uci())
+        self.connection.send(encode_move(move))
+
+    def on_events(self, events):
+        # called on the Tk thread with every frame that arrived since the last poll; the board is
+        # redrawn once for the whole batch
+        moved = False
+        for kind, frame in events:
+            if kind == "closed":
                 print("Server disconnected.")
-                break
-            move_str = data.decode()
-            if len(move_str) == 4 or len(move_str) == 5:
-                move = chess.Move.from_uci(move_str)
+                continue
+            if kind == "reconnecting":
+                print("Connection lost, resuming the game...")
+                continue
+            if kind == "resumed":
+                print("Game resumed.")
+                continue
+            msg_type, payload = frame
+            if msg_type == MSG_SNAPSHOT:
+                # after resuming: the position at the ply we reported (earlier if our last move never arrived),
+                # followed by the moves we missed
+                fen = payload.decode()
+                while self.board.move_stack and self.board.fen() != fen:
+                    self.board.pop()
+                if self.board.fen() != fen:
+                    self.board = chess.Board(fen)
+                moved = True
+            elif msg_type == MSG_MOVE:
+                move = decode_move(payload)
                 self.board.push(move)
-                self.draw_board()
-                print("Received move:", move_str)
+                moved = True
+                print("Received move:", move.uci())
             else:
-                print("Received message:", move_str)
+                text = describe(msg_type, payload)
+                print("Received message:", text)
+                if msg_type == MSG_TEXT and text.startswith("Opponent found. You play "):
+                    # the server may give us the other color when nobody wanted it
+                    self.client_color = text.rstrip(".").rsplit(" ", 1)[1]
+        if moved:
+            self.connection.ply = self.board.ply()
+            self.update_board()
 
     def resign(self):
-        self.server_socket.send("resign".encode())
+        self.connection.send(encode_control(CTRL_RESIGN))
+        self.connection.close()
         self.root.quit()
 
 
 if __name__ == "__main__":
     client = ChessClient()
-    client.root.mainloop()
\ No newline at end of file
+    client.root.mainloop()
+    if client.connection:
+        client.connection.close()
\ No newline at end of file
@@ -0,0 +1,155 @@
+import queue
+import socket
+import threading
+import time
+
+from protocol2 import (MSG_CONTROL, MSG_HELLO, MSG_SESSION, MSG_TEXT, CTRL_ACCEPTED, CTRL_BUSY, CTRL_CHECKMATE,
+                       CTRL_PING, CTRL_PONG, CTRL_RESIGN, encode_control, encode_hello, encode_text, negotiate_version,
+                       recv_frame)
+
+
+class ServerConnection:
+    def __init__(self, host, port, opponent, color, connect_timeout=5.0, handshake_timeout=10.0, resume_timeout=60.0):
+        # all socket I/O for the GUI runs on background threads: one connects, does the handshake and then
+        # reads frames into a queue, another writes. The Tk thread only calls send() and drains the queue
+        # with root.after, so a slow link never freezes the window
+        self.host = host
+        self.port = port
+        self.opponent = opponent
+        self.color = color
+        self.connect_timeout = connect_timeout
+        self.handshake_timeout = handshake_timeout
+        self.resume_timeout = resume_timeout
+        self.sock = None
+        self.handler = None
+        self.token = None  # from the server's session frame; lets the game be resumed after a disconnect
+        self.ply = 0  # plies on the client's board, set by the GUI; the server resends only the moves after it
+        self._closing = False
+        # ("connected", None), ("failed", reason), ("frame", frame), ("reconnecting", None), ("resumed", None),
+        # ("closed", None)
+        self._events = queue.Queue()
+        self._outgoing = queue.Queue()
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def handshake(self, sock, opponent, choice):
+        # returns None on success, otherwise the reason it failed
+        frame = recv_frame(sock)
+        version = negotiate_version(frame[1]) if frame and frame[0] == MSG_HELLO else None
+        if version is None:
+            return "Server did not acknowledge."
+        sock.sendall(encode_hello((version,)))
+        sock.sendall(encode_text(opponent))
+        if recv_frame(sock) != (MSG_CONTROL, bytes([CTRL_ACCEPTED])):
+            return "Server did not accept the opponent type."
+        sock.sendall(encode_text(choice))
+        frame = recv_frame(sock)
+        if frame == (MSG_CONTROL, bytes([CTRL_BUSY])):
+            return "Server is busy, try again later."
+        if frame and frame[0] == MSG_TEXT:
+            return frame[1].decode()
+        if frame != (MSG_CONTROL, bytes([CTRL_ACCEPTED])):
+            return "Server did not accept the color choice."
+        return None
+
+    def _connect(self, opponent, choice):
+        # returns (socket, None) once the handshake went through or (None, reason) if the server refused;
+        # raises OSError if the server could not be reached
+        sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+        try:
+            sock.settimeout(self.handshake_timeout)
+            error = self.handshake(sock, opponent, choice)
+        except OSError:
+            sock.close()
+            raise
+        if error:
+            sock.close()
+            return None, error
+        sock.settimeout(None)  # waiting for the opponent's move can take as long as it takes
+        return sock, None
+
+    def _resume(self):
+        # reconnects with the session token until the server hands the game back, refuses, or time runs out
+        self._events.put(("reconnecting", None))
+        deadline = time.monotonic() + self.resume_timeout
+        while not self._closing and time.monotonic() < deadline:
+            try:
+                sock, error = self._connect("resume", f"{self.token}:{self.ply}")
+            except OSError:
+                time.sleep(1.0)
+                continue
+            if error:
+                print(error)
+                return False
+            old, self.sock = self.sock, sock
+            old.close()
+            self._events.put(("resumed", None))
+            return True
+        return False
+
+    def _read(self):
+        try:
+            self.sock, error = self._connect(self.opponent, self.color)
+        except OSError as e:  # includes connect and handshake timeouts
+            error = f"Could not connect: {e or 'timed out'}"
+        if error:
+            self._events.put(("failed", error))
+            return
+        self._events.put(("connected", None))
+        self._writer.start()
+        while True:
+            try:
+                frame = recv_frame(self.sock)
+            except OSError:
+                frame = None
+            if frame is None:
+                if self.token and not self._closing and self._resume():
+                    continue
+                self._events.put(("closed", None))
+                return
+            if frame == (MSG_CONTROL, bytes([CTRL_PING])):
+                self.send(encode_control(CTRL_PONG))  # answered here so a busy Tk thread never looks dead
+                continue
+            if frame[0] == MSG_SESSION:
+                self.token = frame[1].decode()
+                continue
+            if frame in ((MSG_CONTROL, bytes([CTRL_CHECKMATE])), (MSG_CONTROL, bytes([CTRL_RESIGN])),
+                         (MSG_TEXT, b"Draw."), (MSG_TEXT, b"Move timeout.")):
+                self.token = None  # the game is over, so there is nothing to resume when the server hangs up
+            self._events.put(("frame", frame))
+
+    def _write(self):
+        while True:
+            data = self._outgoing.get()
+            if data is None:
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                pass  # the reader notices the broken connection, and resuming resyncs whatever was lost
+
+    def send(self, data):
+        self._outgoing.put(data)
+
+    def poll(self, root, interval=20):
+        # runs on the Tk thread: hands everything that arrived since the last call to the handler at once,
+        # so a burst of frames costs one redraw
+        events = []
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except queue.Empty:
+                break
+        if events and self.handler:
+            self.handler(events)
+        if not any(kind in ("failed", "closed") for kind, _ in events):
+            root.after(interval, self.poll, root, interval)
+
+    def close(self, timeout=2.0):
+        # lets queued frames (such as a resign) go out before the socket is closed
+        self._closing = True
+        self._outgoing.put(None)
+        if self._writer.is_alive():
+            self._writer.join(timeout)
+        if self.sock:
+            self.sock.close()
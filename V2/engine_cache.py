@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import chess
+import chess.polyglot
+
+
+class EngineCache:
+    def __init__(self, capacity=10000, path=None):
+        # LRU map from (zobrist hash, search limit) to the move (and expected reply) the engine chose there
+        self.capacity = capacity
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def key(self, board, limit):
+        return chess.polyglot.zobrist_hash(board), limit.time, limit.depth, limit.nodes
+
+    def get(self, board, limit):
+        key = self.key(board, limit)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        # the hash ignores move counters and could collide, so never trust an entry that is illegal here
+        if entry is not None and board.is_legal(entry[0]):
+            with self._lock:
+                self.hits += 1
+            return entry
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, board, limit, move, ponder=None):
+        key = self.key(board, limit)
+        with self._lock:
+            self._entries[key] = (move, ponder)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def save(self, path=None):
+        # snapshot in LRU order (oldest first) so a reload keeps the same eviction order
+        path = path or self.path
+        with self._lock:
+            rows = [[f"{key[0]:016x}", key[1], key[2], key[3], move.uci(), ponder.uci() if ponder else None]
+                    for key, (move, ponder) in self._entries.items()]
+        # each save writes its own temporary file, so workers (or both sides of a hot restart) saving the same
+        # cache at once never write into each other's; the last one to finish wins
+        fd, temp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(path) or ".")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(rows, f)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def load(self, path):
+        with open(path) as f:
+            rows = json.load(f)
+        with self._lock:
+            for zobrist, time, depth, nodes, uci, ponder in rows[-self.capacity:]:
+                ponder = chess.Move.from_uci(ponder) if ponder else None
+                self._entries[(int(zobrist, 16), time, depth, nodes)] = (chess.Move.from_uci(uci), ponder)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)  # loading into a cache that is already in use merges the two
@@ -0,0 +1,247 @@
+import asyncio
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import chess.engine
+
+
+class EnginePool:
+    def __init__(self, size=2, command="stockfish", health_check_interval=30.0):
+        # a fixed number of engine processes shared by all game threads
+        self.size = size
+        self.command = command
+        self.health_check_interval = health_check_interval
+        self._idle = queue.LifoQueue()  # LIFO so the most recently used (warm) engine goes out first
+        self._lock = threading.Lock()
+        self._last_checked = {}
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.restarts = 0
+        for _ in range(size):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        engine = chess.engine.SimpleEngine.popen_uci(self.command)
+        self._last_checked[engine] = time.monotonic()
+        return engine
+
+    def _discard(self, engine):
+        self._last_checked.pop(engine, None)
+        try:
+            engine.close()
+        except Exception:
+            pass
+
+    def _restart(self, engine):
+        self._discard(engine)
+        with self._lock:
+            self.restarts += 1
+        print("Restarting engine process.")
+        return self._spawn()
+
+    def _is_healthy(self, engine):
+        # only ping engines that have not been checked for a while, so checkouts stay cheap
+        if time.monotonic() - self._last_checked.get(engine, 0.0) < self.health_check_interval:
+            return True
+        try:
+            engine.ping()
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError, TimeoutError):
+            return False
+        self._last_checked[engine] = time.monotonic()
+        return True
+
+    def acquire(self, timeout=None):
+        # returns (engine, seconds spent waiting in the queue); raises queue.Empty on timeout and
+        # chess.engine.EngineError once no engine is left
+        start = time.monotonic()
+        engine = self._idle.get(timeout=timeout)
+        if engine is None:
+            self._idle.put(None)  # for the next caller
+            raise chess.engine.EngineError("no engine left in the pool")
+        waited = time.monotonic() - start
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        if not self._is_healthy(engine):
+            try:
+                engine = self._restart(engine)
+            except Exception as e:
+                print("Could not restart engine:", e)
+                self._shrink()
+                raise chess.engine.EngineError("could not restart engine") from e
+        return engine, waited
+
+    def try_acquire(self):
+        # non-blocking checkout, returns None if every engine is busy
+        try:
+            return self.acquire(timeout=0)[0]
+        except (queue.Empty, chess.engine.EngineError):
+            return None
+
+    def release(self, engine, broken=False):
+        if broken:
+            try:
+                engine = self._restart(engine)
+            except Exception as e:
+                print("Could not restart engine:", e)
+                self._shrink()
+                return
+        self._idle.put(engine)
+
+    def _shrink(self):
+        # an engine died for good: the pool goes on with one fewer
+        with self._lock:
+            self.size -= 1
+            empty = not self.size
+        if empty:
+            self._idle.put(None)  # nothing will be released again: wake the waiting games instead
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        engine, waited = self.acquire(timeout)
+        broken = False
+        try:
+            yield engine, waited
+        except chess.engine.EngineTerminatedError:
+            broken = True
+            raise
+        finally:
+            self.release(engine, broken)
+
+    def play(self, board, limit, retries=1, timeout=None):
+        # play a move on a pooled engine, retrying on a fresh process if the engine crashed; raises
+        # queue.Empty if no engine is free within timeout seconds
+        for attempt in range(retries + 1):
+            try:
+                with self.checkout(timeout) as (engine, waited):
+                    return engine.play(board, limit), waited
+            except chess.engine.EngineTerminatedError:
+                if attempt == retries:
+                    raise
+
+    def idle(self):
+        return self._idle.qsize() if self.size else 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "idle": self.idle(),
+                "checkouts": self.checkouts,
+                "avg_wait": self.total_wait / self.checkouts if self.checkouts else 0.0,
+                "max_wait": self.max_wait,
+                "restarts": self.restarts,
+            }
+
+    def close(self):
+        while True:
+            try:
+                engine = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if engine is None:
+                continue
+            try:
+                engine.quit()
+            except Exception:
+                self._discard(engine)
+
+
+class AsyncEnginePool:
+    def __init__(self, size=2, command="stockfish"):
+        # asyncio counterpart of EnginePool, built on chess.engine.popen_uci
+        self.size = size
+        self.command = command
+        self._idle = None
+        self._transports = {}
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.restarts = 0
+
+    async def start(self):
+        self._idle = asyncio.LifoQueue()
+        for _ in range(self.size):
+            self._idle.put_nowait(await self._spawn())
+
+    async def _spawn(self):
+        transport, engine = await chess.engine.popen_uci(self.command)
+        self._transports[engine] = transport
+        return engine
+
+    async def _restart(self, engine):
+        transport = self._transports.pop(engine, None)
+        if transport is not None:
+            transport.close()
+        self.restarts += 1
+        print("Restarting engine process.")
+        return await self._spawn()
+
+    async def acquire(self, timeout=None):
+        # raises asyncio.TimeoutError if no engine is free within timeout seconds and chess.engine.EngineError
+        # once no engine is left
+        start = time.monotonic()
+        engine = await asyncio.wait_for(self._idle.get(), timeout)
+        if engine is None:
+            self._idle.put_nowait(None)
+            raise chess.engine.EngineError("no engine left in the pool")
+        waited = time.monotonic() - start
+        self.checkouts += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return engine, waited
+
+    async def release(self, engine, broken=False):
+        if broken:
+            try:
+                engine = await self._restart(engine)
+            except Exception as e:
+                print("Could not restart engine:", e)
+                self.size -= 1
+                if not self.size:
+                    self._idle.put_nowait(None)
+                return
+        self._idle.put_nowait(engine)
+
+    async def play(self, board, limit, retries=1, timeout=None):
+        for attempt in range(retries + 1):
+            engine, waited = await self.acquire(timeout)
+            broken = False
+            try:
+                return await engine.play(board, limit), waited
+            except chess.engine.EngineTerminatedError:
+                broken = True
+                if attempt == retries:
+                    raise
+            finally:
+                await self.release(engine, broken)
+
+    def idle(self):
+        return self._idle.qsize() if self._idle and self.size else 0
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "idle": self.idle(),
+            "checkouts": self.checkouts,
+            "avg_wait": self.total_wait / self.checkouts if self.checkouts else 0.0,
+            "max_wait": self.max_wait,
+            "restarts": self.restarts,
+        }
+
+    async def close(self):
+        while self._idle and not self._idle.empty():
+            engine = self._idle.get_nowait()
+            if engine is None:
+                continue
+            try:
+                await engine.quit()
+            except Exception:
+                pass
+            transport = self._transports.pop(engine, None)
+            if transport is not None:
+                transport.close()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# deterministic stand-in for Stockfish that speaks just enough UCI for the server, so benchmarks are
+# repeatable and run without an engine binary: python3 server2.py --engine-command "python3 fake_engine.py"
+import argparse
+import queue
+import sys
+import threading
+
+import chess
+import chess.polyglot
+
+
+def choose_move(board):
+    # take the most valuable capture, otherwise a move picked by the position's hash
+    moves = sorted(board.legal_moves, key=lambda move: move.uci())
+    if not moves:
+        return None
+    captures = [move for move in moves if board.is_capture(move) and board.piece_at(move.to_square)]
+    if captures:
+        return max(captures, key=lambda move: board.piece_at(move.to_square).piece_type)
+    return moves[chess.polyglot.zobrist_hash(board) % len(moves)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to 'think' per search (capped by movetime)")
+    args = parser.parse_args()
+
+    commands = queue.Queue()
+    threading.Thread(target=read_commands, args=(commands,), daemon=True).start()
+    board = chess.Board()
+    pending = None  # bestmove line held back until "stop" after "go infinite"
+    line = None  # a command that arrived during a search, handled once the search has answered
+    while True:
+        line = line or commands.get()
+        tokens = line.split()
+        line = None
+        if not tokens:
+            continue
+        command = tokens[0]
+        if command == "uci":
+            print("id name FakeEngine\nid author Dichess\nuciok", flush=True)
+        elif command == "isready":
+            print("readyok", flush=True)
+        elif command == "position":
+            if tokens[1] == "startpos":
+                board = chess.Board()
+                rest = tokens[2:]
+            else:
+                board = chess.Board(" ".join(tokens[2:8]))
+                rest = tokens[8:]
+            for uci in rest[1:] if rest and rest[0] == "moves" else []:
+                board.push_uci(uci)
+        elif command == "go":
+            move = choose_move(board)
+            ponder = None
+            if move:
+                board.push(move)
+                ponder = choose_move(board)
+                board.pop()
+            pv = " ".join(m.uci() for m in (move, ponder) if m)
+            bestmove = f"bestmove {move.uci() if move else '(none)'}" + (f" ponder {ponder.uci()}" if ponder else "")
+            print(f"info depth 1 score cp 0 nodes 1 pv {pv}".rstrip(), flush=True)
+            if "infinite" in tokens or "ponder" in tokens:
+                pending = bestmove
+                continue
+            delay = args.delay
+            if "movetime" in tokens:
+                delay = min(delay, int(tokens[tokens.index("movetime") + 1]) / 1000)
+            if delay:
+                try:
+                    line = commands.get(timeout=delay)  # like a real engine, "stop" ends the search early
+                except queue.Empty:
+                    pass
+                if line and line.split()[:1] == ["stop"]:
+                    line = None
+            print(bestmove, flush=True)
+        elif command in ("stop", "ponderhit") and pending:
+            print(pending, flush=True)
+            pending = None
+        elif command == "quit":
+            break
+
+
+def read_commands(commands):
+    for line in sys.stdin:
+        commands.put(line)
+    commands.put("quit")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import argparse
+import bisect
+import fcntl
+import heapq
+import mmap
+import os
+import queue
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+from protocol2 import pack_move, unpack_move
+
+# record: magic, format version, result, white, black, plies, start time, end time, first move ms, reply ms,
+# followed by one little-endian uint16 per ply (same packing as protocol2 moves)
+RECORD = struct.Struct("<2sBBBBHddHH")
+MAGIC = b"DG"
+FORMAT_VERSION = 1
+INDEX_ENTRY = struct.Struct("<QQ")  # zobrist hash of a position, offset of the game it occurs in
+SORTED_HEADER = struct.Struct("<Q")  # number of index entries the sorted copy covers
+
+RESULTS = ["*", "1-0", "0-1", "1/2-1/2"]
+PLAYERS = ["Client", "Server", "Human"]
+
+
+def pack_moves(moves):
+    packed = array("H", (pack_move(move) for move in moves))
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_moves(data):
+    packed = array("H")
+    packed.frombytes(data)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed
+
+
+def read_entries(f, count=None, block_entries=4096):
+    # index entries from an open file, a block at a time; at most `count` of them if given
+    while count is None or count > 0:
+        block = block_entries if count is None else min(block_entries, count)
+        data = f.read(block * INDEX_ENTRY.size)
+        data = data[:len(data) - len(data) % INDEX_ENTRY.size]  # the writer may be in the middle of an entry
+        if not data:
+            return
+        yield from INDEX_ENTRY.iter_unpack(data)
+        if count is not None:
+            count -= len(data) // INDEX_ENTRY.size
+
+
+class GameArchive:
+    def __init__(self, path, flush_interval=1.0):
+        # game threads only queue finished games; one writer thread packs, indexes and appends them
+        self.path = path
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, name="game-archive", daemon=True)
+        self._thread.start()
+        self.games_written = 0
+
+    def record(self, board, white, black, result, started, first_move_ms=0, reply_ms=0):
+        self._queue.put((list(board.move_stack), white, black, result, started, time.time(),
+                         first_move_ms, reply_ms))
+
+    def _write_loop(self):
+        with open(self.path, "ab") as data, open(self.path + ".idx", "ab") as index:
+            # offsets come from tell(), so only one process may append at a time: a server taking over from
+            # another (--hot-restart) queues its games here until the old one has closed the archive
+            try:
+                fcntl.flock(data, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print(f"{self.path} is open in another server, archiving once it is closed.")
+                fcntl.flock(data, fcntl.LOCK_EX)
+            data.seek(0, os.SEEK_END)
+            index.seek(0, os.SEEK_END)
+            last_flush = time.monotonic()
+            while True:
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = None
+                if item is not None and item is not StopIteration:
+                    self._append(data, index, *item)
+                # flush when the burst is over or at least every flush_interval, not after every game
+                if item is StopIteration or self._queue.empty() or time.monotonic() - last_flush > self.flush_interval:
+                    data.flush()
+                    index.flush()
+                    last_flush = time.monotonic()
+                if item is StopIteration:
+                    return
+
+    def _append(self, data, index, moves, white, black, result, started, finished, first_move_ms, reply_ms):
+        offset = data.tell()
+        data.write(RECORD.pack(MAGIC, FORMAT_VERSION, RESULTS.index(result) if result in RESULTS else 0,
+                               PLAYERS.index(white), PLAYERS.index(black), len(moves), started, finished,
+                               first_move_ms, reply_ms))
+        data.write(pack_moves(moves))
+        board = chess.Board()
+        entries = [INDEX_ENTRY.pack(chess.polyglot.zobrist_hash(board), offset)]
+        for move in moves:
+            board.push(move)
+            entries.append(INDEX_ENTRY.pack(chess.polyglot.zobrist_hash(board), offset))
+        index.write(b"".join(entries))
+        self.games_written += 1
+
+    def close(self):
+        self._queue.put(StopIteration)
+        self._thread.join()
+
+
+class ArchivedGame:
+    def __init__(self, offset, fields, moves):
+        _, _, result, white, black, _, started, finished, first_move_ms, reply_ms = fields
+        self.offset = offset
+        self.result = RESULTS[result]
+        self.white = PLAYERS[white]
+        self.black = PLAYERS[black]
+        self.started = started
+        self.finished = finished
+        self.first_move_ms = first_move_ms
+        self.reply_ms = reply_ms
+        self.moves = moves  # array('H') of packed moves
+
+    def board(self):
+        board = chess.Board()
+        for value in self.moves:
+            board.push(unpack_move(value))
+        return board
+
+    def to_pgn(self):
+        game = chess.pgn.Game.from_board(self.board())
+        game.headers["White"] = self.white
+        game.headers["Black"] = self.black
+        game.headers["Result"] = self.result
+        game.headers["Date"] = time.strftime("%Y.%m.%d", time.gmtime(self.started))
+        return game
+
+
+class ArchiveReader:
+    def __init__(self, path):
+        # memory-maps the archive, so iterating millions of games never loads the whole file
+        self.path = path
+        self._file = open(path, "rb")
+        size = os.path.getsize(path)
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def game_at(self, offset):
+        fields = RECORD.unpack_from(self._data, offset)
+        if fields[0] != MAGIC:
+            raise ValueError(f"no game record at offset {offset}")
+        start = offset + RECORD.size
+        return ArchivedGame(offset, fields, unpack_moves(self._data[start:start + 2 * fields[5]]))
+
+    def __iter__(self):
+        offset = 0
+        while offset + RECORD.size <= len(self._data):
+            game = self.game_at(offset)
+            yield game
+            offset += RECORD.size + 2 * len(game.moves)
+
+    def sort_index(self, chunk_entries=1 << 20):
+        # writes a sorted copy of the append-only index so lookups can binary search it. Runs of chunk_entries
+        # entries are sorted into temporary files and then merged, so memory use does not grow with the index
+        total = os.path.getsize(self.path + ".idx") // INDEX_ENTRY.size
+        runs = []
+        try:
+            with open(self.path + ".idx", "rb") as f:
+                for start in range(0, total, chunk_entries):
+                    entries = sorted(read_entries(f, min(chunk_entries, total - start)))
+                    run = tempfile.TemporaryFile(dir=os.path.dirname(self.path) or ".")
+                    run.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in entries))
+                    run.seek(0)
+                    runs.append(run)
+            with open(self.path + ".idx.sorted.tmp", "wb") as f:
+                f.write(SORTED_HEADER.pack(total))
+                batch = []
+                for entry in heapq.merge(*(read_entries(run) for run in runs)):
+                    batch.append(INDEX_ENTRY.pack(*entry))
+                    if len(batch) >= 4096:
+                        f.write(b"".join(batch))
+                        batch.clear()
+                f.write(b"".join(batch))
+        finally:
+            for run in runs:
+                run.close()
+        os.replace(self.path + ".idx.sorted.tmp", self.path + ".idx.sorted")
+
+    def find(self, board):
+        # offsets of games that reached this position: binary search the sorted index, then scan
+        # the entries appended since it was last sorted
+        key = chess.polyglot.zobrist_hash(board)
+        offsets = set()
+        covered = 0
+        if os.path.exists(self.path + ".idx.sorted"):
+            # memory-mapped, so a lookup only touches the pages the binary search visits
+            with open(self.path + ".idx.sorted", "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    covered = SORTED_HEADER.unpack_from(data)[0]
+                    offsets.update(SortedIndex(data, SORTED_HEADER.size).lookup(key))
+        with open(self.path + ".idx", "rb") as f:
+            f.seek(covered * INDEX_ENTRY.size)
+            for entry_key, offset in read_entries(f):
+                if entry_key == key:
+                    offsets.add(offset)
+        return sorted(offsets)
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+
+class SortedIndex:
+    def __init__(self, data, start=0):
+        # sorted index entries in a buffer (bytes or an mmap), beginning `start` bytes in
+        self.data = data
+        self.start = start
+
+    def __len__(self):
+        return (len(self.data) - self.start) // INDEX_ENTRY.size
+
+    def __getitem__(self, position):
+        return INDEX_ENTRY.unpack_from(self.data, self.start + position * INDEX_ENTRY.size)[0]
+
+    def lookup(self, key):
+        position = bisect.bisect_left(self, key)
+        while position < len(self) and self[position] == key:
+            yield INDEX_ENTRY.unpack_from(self.data, self.start + position * INDEX_ENTRY.size)[1]
+            position += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect a game archive written by server2.py --archive.")
+    parser.add_argument("command", choices=["export", "stats", "index", "find"])
+    parser.add_argument("archive")
+    parser.add_argument("fen", nargs="?", help="position to look up with 'find'")
+    args = parser.parse_args()
+
+    reader = ArchiveReader(args.archive)
+    if args.command == "export":
+        for game in reader:
+            print(game.to_pgn(), end="\n\n")
+    elif args.command == "stats":
+        games = plies = 0
+        results = {}
+        for game in reader:
+            games += 1
+            plies += len(game.moves)
+            results[game.result] = results.get(game.result, 0) + 1
+        print(f"{games} games, {plies} plies, results {results}")
+    elif args.command == "index":
+        reader.sort_index()
+        print("Index sorted.")
+    elif args.command == "find":
+        for offset in reader.find(chess.Board(args.fen)):
+            game = reader.game_at(offset)
+            print(offset, game.white, game.black, game.result, len(game.moves))
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import threading
+import time
+
+import chess
+import chess.engine
+
+from admission import Heartbeat
+from engine_cache import EngineCache
+from game_archive import GameArchive
+from legal_moves import LegalMoveCache
+from lite_engine import LiteEngine
+from matchmaking import MatchQueue
+from metrics import MetricsServer, ServerMetrics
+from opening_book import OpeningBook, append_game
+from protocol2 import (MSG_CONTROL, MSG_HELLO, MSG_MOVE, MSG_TEXT, CTRL_ACCEPTED, CTRL_CHECKMATE, CTRL_INVALID,
+                       CTRL_PING, CTRL_PONG, CTRL_RESIGN, DIFFICULTIES, decode_move, encode_control, encode_move,
+                       encode_session, encode_snapshot, encode_text, negotiate_version)
+from session import GameSession
+
+
+class GameServer:
+    def __init__(self, host, port, engine_pool, admission, resumable, spectators, cache_size=10000, cache_file=None,
+                 book=None, pgn_log=None, archive=None, ponder=False, metrics_port=None, debug=False,
+                 handshake_timeout=10.0, move_timeout=600.0, heartbeat_interval=30.0, backlog=128, engine_wait=None):
+        # everything the threaded (server2.py) and asyncio (async_server2.py) servers have in common: their
+        # settings, caches, engines and metrics, and the game logic that does no I/O. The subclasses only add
+        # the sockets or streams and the blocking or awaiting calls around them
+        self.host = host
+        self.port = port
+        self.engine_pool = engine_pool
+        self.engine_wait = engine_wait
+        self.lite_engine = LiteEngine()
+        self.engine_cache = EngineCache(cache_size, cache_file) if cache_size else None
+        self.legal_moves = LegalMoveCache()
+        self.opening_book = OpeningBook(book) if book else None
+        self.pgn_log = pgn_log
+        self._pgn_lock = threading.Lock()
+        self.archive = GameArchive(archive) if archive else None
+        self.first_move_limit = chess.engine.Limit(time=0.5)
+        self.reply_limit = chess.engine.Limit(time=0.1)
+        # (first move, reply) limits per difficulty; easy and medium are always played by the built-in engine
+        self.levels = {
+            "easy": (chess.engine.Limit(depth=1), chess.engine.Limit(depth=1)),
+            "medium": (chess.engine.Limit(depth=3, time=0.5), chess.engine.Limit(depth=3, time=0.3)),
+            "hard": (self.first_move_limit, self.reply_limit),
+        }
+        self.ponder = ponder
+        self.handshake_timeout = handshake_timeout
+        self.move_timeout = move_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.admission = admission
+        self.backlog = backlog
+        self.match_queue = MatchQueue()
+        self.resumable = resumable
+        self.spectators = spectators
+        self._games_lock = threading.Lock()
+        self.games_active = 0
+        self.games_started = 0
+        self.debug = debug
+        self.metrics = ServerMetrics()
+        self.metrics.add_gauge("chess_games_active", "Games in progress.", lambda: self.games_active)
+        self.metrics.add_gauge("chess_engines_idle", "Engines waiting in the pool.",
+                               lambda: self.engine_pool.idle() if self.engine_pool else 0)
+        self.metrics.add_gauge("chess_match_queue_depth", "Players waiting for a human opponent.",
+                               lambda: sum(self.match_queue.depth().values()))
+        self.metrics.add_gauge("chess_admission_waiting", "Clients waiting for a free game slot.",
+                               lambda: self.admission.waiting)
+        self.metrics.add_gauge("chess_spectators", "Spectators watching live games.",
+                               lambda: self.spectators.stats()["watchers"])
+        self.metrics_server = MetricsServer("localhost", metrics_port, self.metrics.render,
+                                            self.stats) if metrics_port else None
+
+    def stats(self):
+        with self._games_lock:
+            games = {"active": self.games_active, "started": self.games_started}
+        return {
+            "games": games,
+            "engines": self.engine_pool.stats() if self.engine_pool else {},
+            "builtin_engine": self.lite_engine.stats(),
+            "cache": self.engine_cache.stats() if self.engine_cache else {},
+            "legal_moves": self.legal_moves.stats(),
+            "matchmaking": self.match_queue.stats(),
+            "admission": self.admission.stats(),
+            "resume": self.resumable.stats(),
+            "spectators": self.spectators.stats(),
+        }
+
+    def read_version(self, frame):
+        # the protocol version agreed on from the client's hello, or None
+        return negotiate_version(frame[1]) if frame and frame[0] == MSG_HELLO else None
+
+    def read_text(self, frame):
+        # bytes that are not UTF-8 just fail the checks
+        if frame is None or frame[0] != MSG_TEXT:
+            return None
+        return frame[1].decode(errors="replace").lower()
+
+    def read_opponent(self, text):
+        # (opponent, difficulty) from "bot", "bot:easy", "human", "watch" or "resume"; None if invalid
+        opponent, _, level = (text or "").partition(":")
+        if opponent not in ["bot", "human", "watch", "resume"] or (
+                level and (opponent != "bot" or level not in DIFFICULTIES)):
+            return None
+        return opponent, level or "hard"
+
+    def read_choice(self, opponent, level, text, version):
+        # the handshake's result from the second text (the color, or a game id or token); None if invalid
+        if opponent in ["watch", "resume"]:
+            return opponent, text, version, None
+        if text not in ["white", "black"]:
+            return None
+        return opponent, text, version, level
+
+    def book_move(self, board):
+        return self.opening_book.move(board) if self.opening_book else None
+
+    def builtin_reason(self, level):
+        # why a reply is played by the built-in engine instead of the pool, or None if it is not
+        if level != "hard":
+            return "difficulty"
+        if self.engine_pool is None:
+            return "no_engine"
+        return None
+
+    def cached_move(self, board, limit):
+        return self.engine_cache.get(board, limit) if self.engine_cache else None
+
+    def remember(self, board, limit, result, waited=None):
+        # an engine or ponder search chose `result`; returns its (move, expected reply)
+        if waited is not None:
+            self.metrics.engine_wait_seconds.observe(waited)
+        if self.engine_cache:
+            self.engine_cache.put(board, limit, result.move, result.ponder)
+        return result.move, result.ponder
+
+    def save_game(self, board, white, black, result, started, limits=()):
+        # the archive only queues the game here; packing and writing happen on its own thread
+        if self.archive and board.move_stack:
+            times = [int(limit.time * 1000) if limit.time else 0 for limit in limits] or [0, 0]
+            self.archive.record(board, white, black, result, started, *times)
+        if self.pgn_log and board.move_stack:
+            with self._pgn_lock:
+                append_game(self.pgn_log, board, white, black, result)
+
+    def open_relay(self, game, versions, adopted=False):
+        # a human game starts (or arrives from another process): its spectator id and one Heartbeat per side
+        game_id = self.spectators.open_game(game.board)
+        heartbeats = {color: Heartbeat(self.heartbeat_interval if version >= 2 else None, self.move_timeout)
+                      for color, version in zip(chess.COLORS, versions)}
+        heartbeats[game.board.turn].start_move()
+        if not adopted:
+            print("Paired two players:", self.match_queue.stats())
+            self.metrics.games_started.inc(label_value="human")
+        return game_id, heartbeats
+
+    def opponent_found(self):
+        return [(color, encode_text(f"Opponent found. You play {chess.COLOR_NAMES[color]}."))
+                for color in chess.COLORS]
+
+    def relay_frame(self, game, game_id, heartbeats, color, frame):
+        # a frame from one side of a human game (None if it dropped); returns (color, data) to send
+        heartbeats[color].seen()
+        if frame == (MSG_CONTROL, bytes([CTRL_PONG])):
+            return []
+        ply = game.board.ply()
+        outputs = game.on_frame(color, frame)
+        if game.board.ply() != ply:
+            self.spectators.publish(game_id, game.board.peek())
+            heartbeats[not game.board.turn].stop_move()
+            heartbeats[game.board.turn].start_move()
+        return outputs
+
+    def relay_heartbeats(self, game, heartbeats):
+        # pings for silent players, and the end of the game for one that stopped answering or ran out of time
+        outputs = []
+        for color, heartbeat in heartbeats.items():
+            if game.over:
+                break
+            if heartbeat.check():
+                outputs.append((color, encode_control(CTRL_PING)))
+            if heartbeat.expired:
+                self.metrics.sessions_expired.inc(label_value=heartbeat.expired)
+                expired = game.on_timeout(color) if heartbeat.expired == "timeout" else None
+                outputs.extend(expired or game.on_frame(color, None))
+        return outputs
+
+    def relay_timeout(self, heartbeats):
+        # seconds until some heartbeat needs checking, or None
+        timeouts = [heartbeat.next_check() for heartbeat in heartbeats.values()]
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def finish_relay(self, game, game_id, started, handed_off=False):
+        self.spectators.finish(game_id, game.result)
+        if not handed_off:
+            self.metrics.games_finished.inc(label_value=game.result)
+            self.metrics.moves_per_game.observe(game.board.ply())
+            self.save_game(game.board, "Human", "Human", game.result, started)
+
+
+class BotGame:
+    def __init__(self, server, client_color, version, level="hard", session=None, token=None, started=None):
+        # referee for a game against the server: keeps the compact session between moves, validates the client's
+        # moves and decides what the client is sent, without doing any I/O itself (like RelayGame for human
+        # games). session, token and started are given for a game handed over by another process
+        self.server = server
+        self.client_color = client_color
+        self.version = version
+        self.level = level
+        self.adopted = session is not None
+        self.session = session or GameSession()
+        if not self.adopted:
+            token = server.resumable.new_token() if version >= 3 and server.resumable.grace else None
+        self.token = token
+        self.started = started or time.time()
+        self.result = "*"
+        self.over = False
+        self.game_id = server.spectators.open_game(self.session.board())
+        self.first_move_limit, self.reply_limit = server.levels[level]
+        self.heartbeat = Heartbeat(server.heartbeat_interval if version >= 2 else None, server.move_timeout)
+        with server._games_lock:
+            server.games_active += 1
+            if not self.adopted:
+                server.games_started += 1
+        if not self.adopted:
+            server.metrics.games_started.inc(label_value="bot")
+
+    def opening(self):
+        # (what the client is sent first, the board the server makes the first move on or None)
+        if self.adopted:
+            return b"", None
+        data = encode_session(self.token) if self.token else b""
+        return data, self.session.board() if self.client_color == "black" else None
+
+    def end_of_game(self, board):
+        # the frame that tells the client the game ended with the last move, or None if it goes on
+        if board.is_checkmate():
+            print("Checkmate! Game over.")
+            self.over = True
+            return encode_control(CTRL_CHECKMATE)
+        if board.is_game_over():
+            print("Draw. Game over.")
+            self.over = True
+            return encode_text("Draw.")
+        return None
+
+    def on_frame(self, frame):
+        # returns (data for the client, board the server replies on or None); over is set if the game ended
+        metrics = self.server.metrics
+        msg_type, payload = frame
+        if msg_type == MSG_CONTROL and payload == bytes([CTRL_RESIGN]):
+            print("Client resigned. Game over.")
+            self.result = "0-1" if self.client_color == "white" else "1-0"
+            self.over = True
+            return encode_control(CTRL_RESIGN), None
+        with metrics.validate_seconds.time():
+            move = decode_move(payload) if msg_type == MSG_MOVE else None
+            board = self.session.board()
+            valid = move is not None and self.server.legal_moves.find(board, move, self.session.key) is not None
+            if valid:
+                self.session.push(board, move)
+        if not valid:
+            metrics.invalid_moves.inc()
+            if self.server.debug:
+                print("Invalid move from client:", move)
+            return encode_control(CTRL_INVALID), None
+        self.server.spectators.publish(self.game_id, move)
+        if self.server.debug:
+            print("Client's move:", move)
+            print(board)
+        over = self.end_of_game(board)
+        if over:
+            return over, None
+        return b"", board
+
+    def on_reply(self, board, move):
+        # the server chose `move` on `board`; returns the data for the client
+        first = not self.session.ply()
+        self.session.push(board, move)
+        self.server.spectators.publish(self.game_id, move)
+        if self.server.debug:
+            print("Server's first move:" if first else "Server's move:", move)
+            print(board)
+        return encode_move(move) + (self.end_of_game(board) or b"")
+
+    def on_lost(self):
+        # the client is gone for good (heartbeat.expired says why, if it did not just disconnect); returns the
+        # data to send it, if any
+        expired = self.heartbeat.expired
+        if expired:
+            self.server.metrics.sessions_expired.inc(label_value=expired)
+        if expired == "timeout":
+            print("Client ran out of time. Game over.")
+            self.result = "0-1" if self.client_color == "white" else "1-0"
+            return encode_text("Move timeout.")
+        print("Client stopped answering." if expired else "Client disconnected.")
+        return b""
+
+    def may_resume(self):
+        # a client that dropped gets to reconnect, unless it lost on time
+        return bool(self.token) and self.heartbeat.expired != "timeout"
+
+    def on_resume(self, ply):
+        # a client came back with `ply` plies; returns the catch-up to send it
+        print("Client resumed the game.")
+        self.heartbeat = Heartbeat(self.heartbeat.interval, self.server.move_timeout)
+        board, missed = self.session.catch_up(ply)
+        return encode_control(CTRL_ACCEPTED) + encode_snapshot(board) + b"".join(encode_move(move) for move in missed)
+
+    def state(self):
+        # what another process needs to carry on with the game (see hot_restart.py)
+        return {"kind": "game", "color": self.client_color, "version": self.version, "level": self.level,
+                "token": self.token, "started": self.started, "moves": list(self.session.moves)}
+
+    def finish(self, handed_off=False):
+        server = self.server
+        with server._games_lock:
+            server.games_active -= 1
+        if handed_off:
+            server.spectators.finish(self.game_id, "*")  # the game goes on in the new process, without spectators
+            return
+        board = self.session.replay()
+        if board.is_game_over():
+            self.result = board.result()
+        server.spectators.finish(self.game_id, self.result)
+        server.metrics.games_finished.inc(label_value=self.result)
+        server.metrics.moves_per_game.observe(board.ply())
+        white, black = ("Client", "Server") if self.client_color == "white" else ("Server", "Client")
+        server.save_game(board, white, black, self.result, self.started, (self.first_move_limit, self.reply_limit))
@@ -0,0 +1,133 @@
+import json
+import os
+import select
+import socket
+import threading
+
+
+class HotRestart:
+    def __init__(self, path):
+        # a server started with the same Unix socket path as a running one takes over from it: the old process
+        # passes its listening socket, then every live game (its state and client sockets) as the game next waits
+        # for a client, and exits once nothing is left. The new process starts its engines before it connects,
+        # so a deploy neither drops games nor leaves them waiting for engines to warm up
+        self.path = path
+        self.channel = None  # connection to the other process while games are handed over
+        self.handing_off = False  # games in this process should move to the new one now
+        self.retired = False  # the listener belongs to a newer server
+        self._lock = threading.Lock()
+        self.wakeup, self._wakeup_sender = os.pipe()  # readable while handing off, so waiting games notice
+        self.handed_off = 0
+        self.adopted = 0
+
+    def take_over(self):
+        # new process: returns the listening socket of the server running on `path`, or None if there is none
+        channel = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            channel.connect(self.path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            channel.close()
+            return None
+        self.channel = channel
+        message, sockets = self.receive()
+        if message is None or message["kind"] != "listener":
+            self.close()
+            return None
+        listener = sockets[0]
+        listener.setblocking(False)
+        return listener
+
+    def receive(self):
+        # the next (message, sockets) from the other process; (None, []) once it has sent everything
+        data, fds, _, _ = socket.recv_fds(self.channel, 65536, 2)
+        sockets = [socket.socket(fileno=fd) for fd in fds]
+        for sock in sockets:
+            sock.setblocking(True)  # the flag is shared with the old process's copy, which may have set a timeout
+        message = json.loads(data) if data else None
+        if message is None or message["kind"] == "done":
+            return None, sockets
+        if message["kind"] != "listener":
+            self.adopted += 1
+        return message, sockets
+
+    def listen(self, on_takeover):
+        # waits on `path` for the next server; on_takeover runs on its own thread once one connects
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        server.bind(self.path)
+        server.listen(1)
+
+        def wait():
+            with server:
+                self.channel, _ = server.accept()
+            on_takeover()
+
+        threading.Thread(target=wait, name="hot-restart", daemon=True).start()
+
+    def begin(self, listener):
+        # old process: hands the listener over and tells every waiting game to move
+        if not self.send({"kind": "listener"}, [listener]):
+            return False
+        self.retired = True
+        self.handing_off = True
+        os.write(self._wakeup_sender, b"\0")
+        return True
+
+    def send(self, message, sockets=()):
+        # False once the hand-off is over, in which case the caller keeps the game
+        with self._lock:
+            if self.channel is None:
+                return False
+            try:
+                socket.send_fds(self.channel, [json.dumps(message).encode()], [sock.fileno() for sock in sockets])
+            except OSError as e:
+                print("Hot restart failed:", e)
+                self._stop()
+                return False
+            if message["kind"] != "listener":
+                self.handed_off += 1
+            return True
+
+    def finish(self):
+        # old process: everything that could move has moved, the rest of the games finish here
+        with self._lock:
+            if self.channel is not None:
+                try:
+                    self.channel.send(json.dumps({"kind": "done"}).encode())
+                except OSError:
+                    pass
+            self._stop()
+
+    def _stop(self):
+        self.close()
+        if self.handing_off:
+            self.handing_off = False
+            os.read(self.wakeup, 1)
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+    def wait(self, sock, timeout):
+        # waits for sock to become readable, or for the hand-off to start; False if the timeout passed first
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        poller.register(self.wakeup, select.POLLIN)
+        return bool(poller.poll(None if timeout is None else timeout * 1000))
+
+    def accept(self, listener):
+        # the next connection, or None once the listener has been handed over
+        while not self.retired:
+            if not self.wait(listener, None) or self.retired:
+                continue
+            try:
+                client_socket, _ = listener.accept()
+            except BlockingIOError:
+                continue  # the other process took it first
+            return client_socket
+        return None
+
+    def stats(self):
+        return {"handed_off": self.handed_off, "adopted": self.adopted, "handing_off": self.handing_off}
@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict
+
+import chess
+import chess.polyglot
+
+
+class LegalMoveCache:
+    def __init__(self, capacity=50000):
+        # legal moves per position, generated once and kept by Zobrist key in an LRU map, indexed by
+        # from-square; the server checks client moves with it and the client uses it for clicks. The key covers
+        # the pieces, side to move, castling rights and a possible en passant capture, which is everything the
+        # legal moves depend on
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def moves(self, board, key=None):
+        # from-square -> legal moves from it; key is the position's Zobrist hash if the caller already has it
+        if key is None:
+            key = chess.polyglot.zobrist_hash(board)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        entry = {}
+        for move in board.generate_legal_moves():
+            entry.setdefault(move.from_square, []).append(move)
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return entry
+
+    def moves_from(self, board, square, key=None):
+        return self.moves(board, key).get(square, [])
+
+    def find(self, board, move, key=None):
+        # the legal move equal to `move`, or None; a pawn reaching the last rank must name its promotion piece
+        for legal in self.moves_from(board, move.from_square, key):
+            if legal == move:
+                return legal
+        return None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "positions": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,293 @@
+import threading
+import time
+
+import chess
+import chess.engine
+
+MATE = 100000
+MAX_PLY = 128
+EXACT, LOWER, UPPER = 0, 1, 2  # what a transposition table score is: exact, at least it, or at most it
+
+PIECE_VALUES = [0, 100, 320, 330, 500, 900, 0]  # indexed by piece type
+
+# piece-square bonuses from white's point of view, written rank 8 first so they read like a board
+PIECE_SQUARES = {
+    chess.PAWN: [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0,
+    ],
+    chess.KNIGHT: [
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ],
+    chess.BISHOP: [
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ],
+    chess.ROOK: [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0,
+    ],
+    chess.QUEEN: [
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20,
+    ],
+    chess.KING: [
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20,
+    ],
+}
+
+# piece value plus square bonus, indexed [color][piece type][square]; black uses the white table mirrored
+SQUARE_VALUES = [[None] * 7, [None] * 7]
+for _piece_type, _table in PIECE_SQUARES.items():
+    SQUARE_VALUES[chess.WHITE][_piece_type] = [PIECE_VALUES[_piece_type] + _table[sq ^ 56] for sq in chess.SQUARES]
+    SQUARE_VALUES[chess.BLACK][_piece_type] = [PIECE_VALUES[_piece_type] + _table[sq] for sq in chess.SQUARES]
+
+
+def evaluate(board):
+    # material and piece placement, from the point of view of the side to move
+    score = 0
+    for piece_type in chess.PIECE_TYPES:
+        white = SQUARE_VALUES[chess.WHITE][piece_type]
+        black = SQUARE_VALUES[chess.BLACK][piece_type]
+        for square in chess.scan_forward(board.pieces_mask(piece_type, chess.WHITE)):
+            score += white[square]
+        for square in chess.scan_forward(board.pieces_mask(piece_type, chess.BLACK)):
+            score -= black[square]
+    return score if board.turn == chess.WHITE else -score
+
+
+def mvv_lva(board, move):
+    # most valuable victim first, cheapest attacker breaking ties
+    victim = board.piece_type_at(move.to_square) or chess.PAWN  # en passant leaves the target square empty
+    return victim * 8 - board.piece_type_at(move.from_square)
+
+
+def to_table(score, ply):
+    # mate scores are stored as distance from the stored node rather than from the root, so an entry stays
+    # right wherever the position is reached again
+    if score > MATE - MAX_PLY:
+        return score + ply
+    if score < MAX_PLY - MATE:
+        return score - ply
+    return score
+
+
+def from_table(score, ply):
+    if score > MATE - MAX_PLY:
+        return score - ply
+    if score < MAX_PLY - MATE:
+        return score + ply
+    return score
+
+
+class SearchStopped(Exception):
+    pass
+
+
+class Search:
+    def __init__(self, table, limit):
+        # one search: iterative deepening over a negamax alpha-beta with quiescence at the leaves
+        self.table = table
+        self.max_depth = min(limit.depth or MAX_PLY // 2, MAX_PLY // 2)
+        self.deadline = time.monotonic() + limit.time if limit.time else None
+        self.max_nodes = limit.nodes
+        self.nodes = 0
+        self.depth = 0
+        self.stoppable = False  # the first iteration always finishes, so there is a move to play
+        self.killers = [[None, None] for _ in range(MAX_PLY)]
+        self.path = []  # keys of the positions between the root and the current node, for repetitions
+        self.best_move = None
+
+    def tick(self):
+        self.nodes += 1
+        if self.nodes & 1023 or not self.stoppable:
+            return
+        if self.deadline and time.monotonic() >= self.deadline:
+            raise SearchStopped
+        if self.max_nodes and self.nodes >= self.max_nodes:
+            raise SearchStopped
+
+    def order(self, board, moves, table_move, killers):
+        def priority(move):
+            if move == table_move:
+                return 10000
+            if board.is_capture(move):
+                return 1000 + mvv_lva(board, move)
+            if move.promotion:
+                return 900 + move.promotion
+            if move in killers:
+                return 800
+            return 0
+
+        moves.sort(key=priority, reverse=True)
+        return moves
+
+    def negamax(self, board, depth, alpha, beta, ply):
+        self.tick()
+        key = board._transposition_key()
+        if ply and (board.halfmove_clock >= 100 or key in self.path):
+            return 0
+        table_move = None
+        entry = self.table.get(key)
+        if entry is not None:
+            entry_depth, score, bound, table_move = entry
+            if ply and entry_depth >= depth:
+                score = from_table(score, ply)
+                if bound == EXACT or (bound == LOWER and score >= beta) or (bound == UPPER and score <= alpha):
+                    return score
+        if depth <= 0:
+            return self.quiesce(board, alpha, beta, ply)
+
+        killers = self.killers[ply]
+        moves = self.order(board, list(board.generate_legal_moves()), table_move, killers)
+        if not moves:
+            return ply - MATE if board.is_check() else 0
+        original_alpha = alpha
+        best_score = -MATE
+        best_move = None
+        self.path.append(key)
+        for move in moves:
+            capture = board.is_capture(move)
+            board.push(move)
+            score = -self.negamax(board, depth - 1, -beta, -alpha, ply + 1)
+            board.pop()
+            if score > best_score:
+                best_score = score
+                best_move = move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if not capture and move != killers[0]:
+                    killers[1] = killers[0]
+                    killers[0] = move
+                break
+        self.path.pop()
+
+        bound = UPPER if best_score <= original_alpha else LOWER if best_score >= beta else EXACT
+        self.table[key] = (depth, to_table(best_score, ply), bound, best_move)
+        if not ply:
+            self.best_move = best_move
+        return best_score
+
+    def quiesce(self, board, alpha, beta, ply):
+        # only captures, until the position is quiet, so the evaluation never stops in the middle of a trade
+        self.tick()
+        if not any(board.generate_legal_moves()):
+            return ply - MATE if board.is_check() else 0  # a leaf can be mate or stalemate, not just a quiet position
+        score = evaluate(board)
+        if score >= beta:
+            return score
+        alpha = max(alpha, score)
+        captures = sorted(board.generate_legal_captures(), key=lambda move: mvv_lva(board, move), reverse=True)
+        for move in captures:
+            board.push(move)
+            score = -self.quiesce(board, -beta, -alpha, ply + 1)
+            board.pop()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    def run(self, board):
+        best = None
+        for depth in range(1, self.max_depth + 1):
+            self.stoppable = depth > 1
+            try:
+                score = self.negamax(board, depth, -MATE, MATE, 0)
+            except SearchStopped:
+                break
+            best = self.best_move
+            self.depth = depth
+            if abs(score) > MATE - MAX_PLY:
+                break  # a forced mate was found, searching deeper will not change the move
+        return best
+
+
+def history(board):
+    # keys of the positions on the board's move stack, so the search scores going back to one of them as a draw
+    board = board.copy()
+    keys = []
+    while board.move_stack:
+        board.pop()
+        keys.append(board._transposition_key())
+    return keys
+
+
+class LiteEngine:
+    def __init__(self, table_size=200000):
+        # a small alpha-beta engine that runs inside the server process, for low difficulty games and for
+        # when no external engine is available; play() takes the same limits and returns the same result
+        # as chess.engine.SimpleEngine.play. The transposition table is shared by every game
+        self.table_size = table_size
+        self._table = {}  # transposition key -> (depth, score, bound, best move)
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.nodes = 0
+        self.seconds = 0.0
+
+    def play(self, board, limit):
+        start = time.monotonic()
+        if len(self._table) > self.table_size:
+            self._table.clear()
+        search = Search(self._table, limit)
+        search.path = history(board)
+        move = search.run(board.copy(stack=False))  # a stopped search leaves its copy in the middle of a line
+        ponder = None
+        if move is not None:
+            board = board.copy(stack=False)
+            board.push(move)
+            entry = self._table.get(board._transposition_key())
+            if entry is not None and entry[3] is not None and board.is_legal(entry[3]):
+                ponder = entry[3]
+        with self._lock:
+            self.searches += 1
+            self.nodes += search.nodes
+            self.seconds += time.monotonic() - start
+        return chess.engine.PlayResult(move, ponder, info={"depth": search.depth, "nodes": search.nodes})
+
+    def stats(self):
+        with self._lock:
+            return {
+                "searches": self.searches,
+                "nodes": self.nodes,
+                "nodes_per_sec": round(self.nodes / self.seconds) if self.seconds else 0,
+                "table_entries": len(self._table),
+            }
@@ -0,0 +1,168 @@
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+
+import chess
+
+from protocol2 import (MSG_CONTROL, MSG_HELLO, MSG_MOVE, MSG_SESSION, CTRL_ACCEPTED, CTRL_BUSY, CTRL_PING, CTRL_PONG,
+                       CTRL_RESIGN, DIFFICULTIES, decode_move, encode_control, encode_hello, encode_move, encode_text,
+                       negotiate_version, recv_frame)
+
+
+class ServerBusy(ConnectionError):
+    pass
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class SimulatedPlayer:
+    def __init__(self, host, port, color, rng, max_moves, think_time, timeout, difficulty=None):
+        # headless client that plays random legal moves over the same handshake and frames as client2.py
+        self.host = host
+        self.port = port
+        self.color = color
+        self.rng = rng
+        self.max_moves = max_moves
+        self.think_time = think_time
+        self.timeout = timeout
+        self.opponent = f"bot:{difficulty}" if difficulty else "bot"
+        self.latencies = []
+
+    def expect_accepted(self, sock):
+        frame = recv_frame(sock)
+        if frame == (MSG_CONTROL, bytes([CTRL_BUSY])):
+            raise ServerBusy("server is busy")
+        if frame != (MSG_CONTROL, bytes([CTRL_ACCEPTED])):
+            raise ConnectionError("server did not accept the handshake")
+
+    def receive_reply(self, sock, board, sent_at):
+        # returns False once the game is over
+        frame = recv_frame(sock)
+        while frame == (MSG_CONTROL, bytes([CTRL_PING])) or (frame and frame[0] == MSG_SESSION):
+            if frame[0] == MSG_CONTROL:
+                sock.sendall(encode_control(CTRL_PONG))
+            frame = recv_frame(sock)
+        if frame is None:
+            raise ConnectionError("server closed the connection")
+        msg_type, payload = frame
+        if msg_type != MSG_MOVE:
+            return False
+        self.latencies.append(time.perf_counter() - sent_at)
+        board.push(decode_move(payload))
+        return not board.is_game_over()
+
+    def play_game(self):
+        with socket.create_connection((self.host, self.port), timeout=self.timeout) as sock:
+            frame = recv_frame(sock)
+            version = negotiate_version(frame[1]) if frame and frame[0] == MSG_HELLO else None
+            if version is None:
+                raise ConnectionError("no common protocol version")
+            sock.sendall(encode_hello((version,)))
+            sock.sendall(encode_text(self.opponent))
+            self.expect_accepted(sock)
+            sock.sendall(encode_text(self.color))
+            self.expect_accepted(sock)
+
+            board = chess.Board()
+            sent_at = time.perf_counter()
+            if self.color == "black" and not self.receive_reply(sock, board, sent_at):
+                return
+            for _ in range(self.max_moves):
+                if self.think_time:
+                    time.sleep(self.think_time)
+                move = self.rng.choice(list(board.legal_moves))
+                board.push(move)
+                sent_at = time.perf_counter()
+                sock.sendall(encode_move(move))
+                if not self.receive_reply(sock, board, sent_at):
+                    return
+            sock.sendall(encode_control(CTRL_RESIGN))
+            recv_frame(sock)
+
+
+def run(host, port, players, games, max_moves, think_time, seed, timeout=30.0, difficulty=None):
+    # every player runs `games` games back to back on its own thread
+    results = []
+    errors = []
+    busy = []
+    lock = threading.Lock()
+
+    def player_loop(index):
+        rng = random.Random(seed + index)
+        for game in range(games):
+            color = "white" if (index + game) % 2 == 0 else "black"
+            player = SimulatedPlayer(host, port, color, rng, max_moves, think_time, timeout, difficulty)
+            try:
+                player.play_game()
+            except ServerBusy as e:
+                with lock:
+                    busy.append(str(e))
+                continue
+            except (OSError, ConnectionError) as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                results.append(player.latencies)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=player_loop, args=(index,)) for index in range(players)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for game in results for latency in game)
+    return {
+        "players": players,
+        "games": len(results),
+        "errors": len(errors),
+        "busy": len(busy),
+        "moves": len(latencies),
+        "seconds": round(elapsed, 3),
+        "games_per_sec": round(len(results) / elapsed, 3),
+        "moves_per_sec": round(len(latencies) / elapsed, 3),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless load generator for the V2 chess server.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--players", type=int, default=10, help="concurrent simulated players")
+    parser.add_argument("--games", type=int, default=1, help="games per player")
+    parser.add_argument("--moves", type=int, default=40, help="resign after this many of our own moves")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds each player waits before moving")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--difficulty", choices=DIFFICULTIES, default=None, help="bot difficulty to ask for")
+    parser.add_argument("--label", default="", help="name for this run, e.g. the server version")
+    parser.add_argument("--output", default=None, help="append the result as one JSON line to this file")
+    args = parser.parse_args()
+
+    result = run(args.host, args.port, args.players, args.games, args.moves, args.think_time, args.seed,
+                 difficulty=args.difficulty)
+    result["label"] = args.label
+    result["timestamp"] = time.time()
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
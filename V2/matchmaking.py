@@ -0,0 +1,129 @@
+import select
+import socket
+import threading
+import time
+from collections import deque
+
+import chess
+
+from protocol2 import (MSG_CONTROL, MSG_MOVE, CTRL_CHECKMATE, CTRL_INVALID, CTRL_RESIGN, decode_move, encode_control,
+                       encode_move, encode_text)
+
+
+class MatchQueue:
+    def __init__(self):
+        # players waiting for a human opponent, one FIFO per color they asked for
+        self._waiting = {"white": deque(), "black": deque()}
+        self._lock = threading.Lock()
+        self.pairs = 0
+        self.abandoned = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def join(self, player, color, alive=None):
+        # returns (white player, black player) if someone is waiting, otherwise queues the player. Someone who
+        # wanted the other color is preferred; failing that, a player who asked for the same color keeps it and
+        # the new player gets the other one
+        other = "black" if color == "white" else "white"
+        now = time.monotonic()
+        with self._lock:
+            for queue, gets_color in ((other, color), (color, other)):
+                while self._waiting[queue]:
+                    opponent, since = self._waiting[queue].popleft()
+                    if alive and not alive(opponent):
+                        self.abandoned += 1
+                        continue
+                    waited = now - since
+                    self.pairs += 1
+                    self.total_wait += waited
+                    self.max_wait = max(self.max_wait, waited)
+                    return (player, opponent) if gets_color == "white" else (opponent, player)
+            self._waiting[color].append((player, now))
+            return None
+
+    def leave(self, player):
+        with self._lock:
+            for waiting in self._waiting.values():
+                for entry in waiting:
+                    if entry[0] is player:
+                        waiting.remove(entry)
+                        return True
+        return False
+
+    def drain(self):
+        # removes and returns every waiting (player, color), for handing them to another process
+        with self._lock:
+            players = [(player, color) for color, waiting in self._waiting.items() for player, _ in waiting]
+            for waiting in self._waiting.values():
+                waiting.clear()
+            return players
+
+    def depth(self):
+        with self._lock:
+            return {color: len(waiting) for color, waiting in self._waiting.items()}
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            oldest = [now - waiting[0][1] for waiting in self._waiting.values() if waiting]
+            return {
+                "waiting_white": len(self._waiting["white"]),
+                "waiting_black": len(self._waiting["black"]),
+                "pairs": self.pairs,
+                "abandoned": self.abandoned,
+                "avg_wait": self.total_wait / self.pairs if self.pairs else 0.0,
+                "max_wait": self.max_wait,
+                "oldest_wait": max(oldest, default=0.0),
+            }
+
+
+def socket_alive(sock):
+    # a waiting client that hung up shows up as readable with nothing to read
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return not readable or sock.recv(1, socket.MSG_PEEK) != b""
+    except OSError:
+        return False
+
+
+class RelayGame:
+    def __init__(self, legal_moves):
+        # referee for a human vs human game: validates moves (with the server's LegalMoveCache) and decides
+        # what each side is sent, without doing any I/O itself so the threaded and asyncio servers can share it
+        self.legal_moves = legal_moves
+        self.board = chess.Board()
+        self.result = "*"
+        self.over = False
+
+    def forfeit(self, color):
+        self.over = True
+        self.result = "0-1" if color == chess.WHITE else "1-0"
+
+    def on_timeout(self, color):
+        self.forfeit(color)
+        return [(not color, encode_text("Opponent ran out of time.")), (color, encode_text("Move timeout."))]
+
+    def on_frame(self, color, frame):
+        # returns a list of (color, data) to send
+        opponent = not color
+        if frame is None:
+            self.forfeit(color)
+            return [(opponent, encode_text("Opponent disconnected."))]
+        msg_type, payload = frame
+        if msg_type == MSG_CONTROL and payload == bytes([CTRL_RESIGN]):
+            self.forfeit(color)
+            return [(opponent, encode_control(CTRL_RESIGN)), (color, encode_control(CTRL_RESIGN))]
+        move = decode_move(payload) if msg_type == MSG_MOVE else None
+        if move is None or self.board.turn != color or self.legal_moves.find(self.board, move) is None:
+            return [(color, encode_control(CTRL_INVALID))]
+        self.board.push(move)
+        if self.board.is_checkmate():
+            self.over = True
+            self.result = self.board.result()
+            return [(opponent, encode_move(move) + encode_control(CTRL_CHECKMATE)),
+                    (color, encode_control(CTRL_CHECKMATE))]
+        if self.board.is_game_over():
+            self.over = True
+            self.result = self.board.result()
+            return [(opponent, encode_move(move) + encode_text("Draw.")), (color, encode_text("Draw."))]
+        return [(opponent, encode_move(move))]
@@ -0,0 +1,140 @@
+import argparse
+import gc
+import json
+import random
+import resource
+import socket
+import time
+import tracemalloc
+
+import chess
+
+from protocol2 import MSG_HELLO, MSG_MOVE, encode_hello, encode_move, encode_text, recv_frame
+from session import GameSession
+from spectators import SpectatorRegistry
+
+
+def random_games(count, plies, seed):
+    rng = random.Random(seed)
+    games = []
+    for _ in range(count):
+        board = chess.Board()
+        moves = []
+        while len(moves) < plies and not board.is_game_over():
+            move = rng.choice(list(board.legal_moves))
+            board.push(move)
+            moves.append(move)
+        games.append(moves)
+    return games
+
+
+def bytes_per_game(build, games):
+    # traced allocations of keeping every game alive at once, divided by the number of games
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build(moves) for moves in games]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / len(games)
+
+
+def board_state(moves):
+    board = chess.Board()
+    for move in moves:
+        board.push(move)
+    return board
+
+
+def session_state(moves):
+    session = GameSession()
+    for move in moves:
+        session.push(session.board(), move)
+    return session
+
+
+def served_state(registry):
+    # what the server really keeps per idle bot game: the session plus the game's entry in the spectator
+    # registry, which every game gets whether or not anyone watches it
+    def build(moves):
+        session = GameSession()
+        game_id = registry.open_game(session.board())
+        for move in moves:
+            session.push(session.board(), move)
+            registry.publish(game_id, move)
+        return session
+
+    return build
+
+
+def rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def open_idle_games(host, port, count, timeout=30.0):
+    # bot games that play one move each and then sit waiting, like a human who is thinking
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    sockets = []
+    for _ in range(count):
+        sock = socket.create_connection((host, port), timeout=timeout)
+        frame = recv_frame(sock)
+        if not (frame and frame[0] == MSG_HELLO and 1 in frame[1]):
+            raise ConnectionError("server does not speak protocol 1")
+        sock.sendall(encode_hello((1,)) + encode_text("bot"))  # protocol 1 has no heartbeats, so sockets stay silent
+        recv_frame(sock)
+        sock.sendall(encode_text("white"))
+        recv_frame(sock)
+        sock.sendall(encode_move(chess.Move.from_uci("e2e4")))
+        if recv_frame(sock)[0] != MSG_MOVE:
+            raise ConnectionError("server did not reply to the first move")
+        sockets.append(sock)
+    return sockets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="How many idle games fit in a memory budget.")
+    parser.add_argument("--games", type=int, default=10000, help="games to build for the per-game state measurement")
+    parser.add_argument("--plies", type=int, default=40, help="plies already played in every idle game")
+    parser.add_argument("--budget-mb", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--server-pid", type=int, default=None,
+                        help="also open --connections idle games against a running server and measure its RSS")
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5555)
+    args = parser.parse_args()
+
+    games = random_games(args.games, args.plies, args.seed)
+    budget = args.budget_mb * 1024 * 1024
+    result = {"plies": args.plies, "budget_mb": args.budget_mb, "state": {}}
+    builders = (("board", board_state), ("session", session_state),
+                ("session_with_spectators", served_state(SpectatorRegistry())))
+    for name, build in builders:
+        size = bytes_per_game(build, games)
+        result["state"][name] = {"bytes_per_game": round(size), "games_in_budget": int(budget // size)}
+
+    if args.server_pid:
+        before = rss_kb(args.server_pid)
+        start = time.perf_counter()
+        sockets = open_idle_games(args.host, args.port, args.connections)
+        time.sleep(1.0)
+        grown = (rss_kb(args.server_pid) - before) * 1024
+        result["server"] = {
+            "connections": len(sockets),
+            "seconds_to_open": round(time.perf_counter() - start, 3),
+            "rss_bytes_per_game": round(grown / len(sockets)),
+            "games_in_budget": int(budget // max(1, grown / len(sockets))),
+        }
+        for sock in sockets:
+            sock.close()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter:
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, label_value=None):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values) or {None: 0}
+        for label_value, value in sorted(values.items(), key=lambda item: str(item[0])):
+            labels = f'{{{self.label}="{label_value}"}}' if self.label and label_value is not None else ""
+            lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        # fixed buckets, so observing is a bisect and two additions under a lock
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+    def render(self):
+        counts, total = self.snapshot()
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help_text, read):
+        # value is read when the endpoint is scraped, so nothing is recorded on the hot path
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+
+class ServerMetrics:
+    def __init__(self):
+        self.recv_seconds = Histogram("chess_recv_seconds", "Time spent waiting for a frame from the client.")
+        self.validate_seconds = Histogram("chess_validate_seconds", "Time spent checking and applying a client move.")
+        self.engine_seconds = Histogram("chess_engine_seconds",
+                                        "Time spent choosing the server's reply (book, cache, ponder or engine).")
+        self.send_seconds = Histogram("chess_send_seconds", "Time spent writing a reply to the client.")
+        self.engine_wait_seconds = Histogram("chess_engine_wait_seconds",
+                                             "Time a move waited for a free engine in the pool.")
+        self.moves_per_game = Histogram("chess_moves_per_game", "Plies played in finished games.",
+                                        buckets=(10, 20, 40, 60, 80, 120, 160, 240))
+        self.games_started = Counter("chess_games_started_total", "Games started.", label="opponent")
+        self.games_finished = Counter("chess_games_finished_total", "Games finished, by result.", label="result")
+        self.invalid_moves = Counter("chess_invalid_moves_total", "Moves rejected by the server.")
+        self.busy_rejections = Counter("chess_busy_rejections_total",
+                                       "Clients turned away because the server was full.")
+        self.sessions_expired = Counter("chess_sessions_expired_total",
+                                        "Games ended because a client stopped answering or ran out of time.",
+                                        label="reason")
+        self.builtin_moves = Counter("chess_builtin_engine_moves_total",
+                                     "Moves played by the built-in engine instead of the engine pool.", label="reason")
+        self.metrics = [self.recv_seconds, self.validate_seconds, self.engine_seconds, self.send_seconds,
+                        self.engine_wait_seconds,
+                        self.moves_per_game, self.games_started, self.games_finished, self.invalid_moves,
+                        self.busy_rejections, self.sessions_expired, self.builtin_moves]
+
+    def add_gauge(self, name, help_text, read):
+        self.metrics.append(Gauge(name, help_text, read))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    def __init__(self, host, port, render=None, stats=None):
+        # local HTTP endpoint: /metrics in Prometheus text format, /stats as JSON
+        self.host = host
+        self.port = port
+        self.render = render
+        self.stats = stats
+        self._httpd = None
+
+    def start(self):
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics" and owner.render:
+                    body, content_type = owner.render().encode(), "text/plain; version=0.0.4"
+                elif self.path == "/stats" and owner.stats:
+                    body, content_type = json.dumps(owner.stats(), indent=2).encode(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        print(f"Metrics on http://{self.host}:{self.port}/metrics")
+
+    def stop(self):
+        httpd, self._httpd = self._httpd, None
+        if httpd:
+            httpd.shutdown()
+            httpd.server_close()
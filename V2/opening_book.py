@@ -0,0 +1,88 @@
+import os
+import random
+import struct
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+ENTRY = struct.Struct(">QHHI")  # polyglot entry: key, move, weight, learn
+
+
+class OpeningBook:
+    def __init__(self, path, max_ply=30, rng=None):
+        # probes a Polyglot book before the engine is asked for a move
+        self.path = path
+        self.max_ply = max_ply
+        self.rng = rng or random.Random()
+        self._reader = chess.polyglot.open_reader(path)
+        self.hits = 0
+        self.misses = 0
+
+    def move(self, board):
+        if board.ply() > self.max_ply:
+            return None
+        try:
+            entry = self._reader.weighted_choice(board, random=self.rng)
+        except IndexError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.move
+
+    def close(self):
+        self._reader.close()
+
+
+def polyglot_move(board, move):
+    # polyglot encodes castling as the king capturing its own rook and promotions as piece type - 1
+    to_square = move.to_square
+    if board.is_castling(move):
+        to_square = chess.square(7 if board.is_kingside_castling(move) else 0, chess.square_rank(move.from_square))
+    promotion = move.promotion - 1 if move.promotion else 0
+    return to_square | (move.from_square << 6) | (promotion << 12)
+
+
+def read_book(path):
+    # returns {(key, raw_move): [weight, learn]} for an existing book, or an empty dict
+    entries = {}
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return entries
+    with open(path, "rb") as f:
+        data = f.read()
+    for key, raw_move, weight, learn in ENTRY.iter_unpack(data):
+        entries[(key, raw_move)] = [weight, learn]
+    return entries
+
+
+def write_book(path, entries):
+    # polyglot readers binary search on the key, so entries must be sorted
+    with open(path + ".tmp", "wb") as f:
+        for (key, raw_move), (weight, learn) in sorted(entries.items()):
+            if weight > 0:
+                f.write(ENTRY.pack(key, raw_move, min(weight, 0xFFFF), learn))
+    os.replace(path + ".tmp", path)
+
+
+def add_game(entries, game, max_ply=30):
+    # weight moves by the mover's result: 2 for a win, 1 for a draw or unfinished game, 0 for a loss
+    result = game.headers.get("Result", "*")
+    scores = {"1-0": (2, 0), "0-1": (0, 2)}.get(result, (1, 1))
+    board = game.board()
+    for ply, move in enumerate(game.mainline_moves()):
+        if ply >= max_ply:
+            break
+        weight = scores[0] if board.turn == chess.WHITE else scores[1]
+        entry = entries.setdefault((chess.polyglot.zobrist_hash(board), polyglot_move(board, move)), [0, 0])
+        entry[0] += weight
+        board.push(move)
+
+
+def append_game(path, board, white, black, result):
+    # played games are logged as PGN so build_book.py can feed them back into the book
+    game = chess.pgn.Game.from_board(board)
+    game.headers["White"] = white
+    game.headers["Black"] = black
+    game.headers["Result"] = result
+    with open(path, "a") as f:
+        print(game, file=f, end="\n\n")
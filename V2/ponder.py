@@ -0,0 +1,149 @@
+import asyncio
+import threading
+import time
+
+import chess.engine
+
+
+class Ponderer:
+    def __init__(self, pool, reserve=1, budget=3):
+        # searches the position after the client's expected reply while the client is thinking
+        self.pool = pool
+        self.reserve = reserve  # engines always left free for real moves; a smaller pool never ponders
+        self.budget = budget  # the search ends after this many move times, so a client that idles cannot keep an engine
+        self._search = None  # thread holding the engine until the search ends
+        self._analysis = None
+        self._best = None
+        self._predicted = None
+        self._started = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def start(self, board, predicted, limit):
+        # board is the position the client is to move in, limit the one the server's reply will be searched with
+        if self._search is not None or predicted is None or not board.is_legal(predicted):
+            return
+        if self.pool.size <= self.reserve or self.pool.idle() <= self.reserve:
+            return
+        engine = self.pool.try_acquire()
+        if engine is None:
+            return
+        ponder_board = board.copy()  # with the moves since the last irreversible one, so repetitions count
+        ponder_board.push(predicted)
+        try:
+            analysis = engine.analysis(ponder_board, bounded(limit, self.budget))
+        except chess.engine.EngineTerminatedError:
+            self.pool.release(engine, broken=True)
+            return
+        self._analysis = analysis
+        self._best = None
+        self._predicted = predicted
+        self._started = time.monotonic()
+        self._search = threading.Thread(target=self._finish, args=(engine, analysis), name="ponder", daemon=True)
+        self._search.start()
+
+    def _finish(self, engine, analysis):
+        # the engine goes back to the pool as soon as the search ends, keeping its result for resolve()
+        broken = False
+        try:
+            self._best = analysis.wait()
+        except chess.engine.EngineTerminatedError:
+            broken = True
+        self.pool.release(engine, broken)
+
+    def resolve(self, move, limit):
+        # returns the BestMove of the speculative search if the client played the predicted move,
+        # otherwise None
+        if self._search is None:
+            return None
+        search, analysis = self._search, self._analysis
+        self._search = self._analysis = None
+        hit = move is not None and move == self._predicted
+        if hit and limit.time:
+            # keep searching until the normal time budget is spent so playing strength is unchanged
+            remaining = limit.time - (time.monotonic() - self._started)
+            if remaining > 0:
+                search.join(remaining)
+        try:
+            analysis.stop()  # nothing to stop if the budget already ended the search
+        except chess.engine.EngineTerminatedError:
+            pass
+        search.join()
+        best = self._best
+        if hit and best is not None and best.move is not None:
+            self.hits += 1
+            return best
+        self.misses += 1
+        return None
+
+    def cancel(self):
+        self.resolve(None, None)
+
+
+class AsyncPonderer:
+    def __init__(self, pool, reserve=1, budget=3):
+        # asyncio counterpart of Ponderer for AsyncEnginePool
+        self.pool = pool
+        self.reserve = reserve
+        self.budget = budget
+        self._search = None  # task holding the engine until the search ends
+        self._analysis = None
+        self._best = None
+        self._predicted = None
+        self._started = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    async def start(self, board, predicted, limit):
+        if self._search is not None or predicted is None or not board.is_legal(predicted):
+            return
+        if self.pool.size <= self.reserve or self.pool.idle() <= self.reserve:
+            return
+        engine, _ = await self.pool.acquire()
+        ponder_board = board.copy()
+        ponder_board.push(predicted)
+        try:
+            analysis = await engine.analysis(ponder_board, bounded(limit, self.budget))
+        except chess.engine.EngineTerminatedError:
+            await self.pool.release(engine, broken=True)
+            return
+        self._analysis = analysis
+        self._best = None
+        self._predicted = predicted
+        self._started = time.monotonic()
+        self._search = asyncio.ensure_future(self._finish(engine, analysis))
+
+    async def _finish(self, engine, analysis):
+        broken = False
+        try:
+            self._best = await analysis.wait()
+        except chess.engine.EngineTerminatedError:
+            broken = True
+        await self.pool.release(engine, broken)
+
+    async def resolve(self, move, limit):
+        if self._search is None:
+            return None
+        search, analysis = self._search, self._analysis
+        self._search = self._analysis = None
+        hit = move is not None and move == self._predicted
+        if hit and limit.time:
+            remaining = limit.time - (time.monotonic() - self._started)
+            if remaining > 0:
+                await asyncio.wait({search}, timeout=remaining)
+        analysis.stop()
+        await search
+        best = self._best
+        if hit and best is not None and best.move is not None:
+            self.hits += 1
+            return best
+        self.misses += 1
+        return None
+
+    async def cancel(self):
+        await self.resolve(None, None)
+
+
+def bounded(limit, budget):
+    # the limit a ponder search runs under: `budget` times the move time, or the move's own depth or node limit
+    return chess.engine.Limit(time=limit.time * budget) if limit.time else limit
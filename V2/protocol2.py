@@ -1,9 +1,140 @@
-# later on I want this to be converted to binary and then decoded from binary
+# every message is a frame: a 1 byte type and a 2 byte payload length, followed by the payload
+import asyncio
+import struct
+
+import chess
+
+SUPPORTED_VERSIONS = (1, 2, 3)  # 2 adds heartbeats (CTRL_PING/CTRL_PONG), 3 adds resuming games (MSG_SESSION)
+PROTOCOL_VERSION = max(SUPPORTED_VERSIONS)
+
+HEADER = struct.Struct(">BH")
+MOVE = struct.Struct(">H")
+
+# frame types
+MSG_HELLO = 1    # payload: protocol versions the sender speaks, one byte each
+MSG_TEXT = 2     # payload: utf-8 text (handshake choices, server notices)
+MSG_MOVE = 3     # payload: a move packed into 16 bits
+MSG_CONTROL = 4  # payload: a single control code
+MSG_SNAPSHOT = 5  # payload: utf-8 FEN of the current position, sent to spectators and resuming clients
+MSG_SESSION = 6   # payload: utf-8 token the client can resume its game with after losing the connection
+
+# control codes
+CTRL_ACCEPTED = 1
+CTRL_CHECKMATE = 2
+CTRL_RESIGN = 3
+CTRL_INVALID = 4
+CTRL_BUSY = 5  # sent instead of accepting the color choice when the server has no room for another game
+CTRL_PING = 6  # the server checks that a silent client is still there; it answers CTRL_PONG
+CTRL_PONG = 7
+
+# a bot opponent may be sent as "bot:<difficulty>"; plain "bot" means "hard"
+DIFFICULTIES = ("easy", "medium", "hard")
+
+CONTROL_NAMES = {
+    CTRL_ACCEPTED: "Accepted",
+    CTRL_CHECKMATE: "checkmate",
+    CTRL_RESIGN: "resign",
+    CTRL_INVALID: "Invalid",
+    CTRL_BUSY: "busy",
+    CTRL_PING: "ping",
+    CTRL_PONG: "pong",
+}
+
+
+def pack_move(move):
+    # bits 0-5 from square, 6-11 to square, 12-14 promotion piece type (0 for none)
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+
+def unpack_move(value):
+    # None if the promotion bits name no piece a pawn can become
+    promotion = (value >> 12) & 0x7
+    if promotion and not chess.KNIGHT <= promotion <= chess.QUEEN:
+        return None
+    return chess.Move(value & 0x3F, (value >> 6) & 0x3F, promotion or None)
+
+
+def encode_frame(msg_type, payload=b""):
+    return HEADER.pack(msg_type, len(payload)) + payload
+
 
 def encode_move(move):
-    # encode the move as a string
-    return str(move)
+    return encode_frame(MSG_MOVE, MOVE.pack(pack_move(move)))
+
+
+def decode_move(payload):
+    if len(payload) != MOVE.size:
+        return None
+    return unpack_move(MOVE.unpack(payload)[0])
+
+
+def encode_text(text):
+    return encode_frame(MSG_TEXT, text.encode())
+
+
+def encode_snapshot(board):
+    return encode_frame(MSG_SNAPSHOT, board.fen().encode())
+
+
+def encode_session(token):
+    return encode_frame(MSG_SESSION, token.encode())
+
+
+def encode_control(code):
+    return encode_frame(MSG_CONTROL, bytes([code]))
+
+
+def encode_hello(versions=SUPPORTED_VERSIONS):
+    return encode_frame(MSG_HELLO, bytes(versions))
+
+
+def negotiate_version(offered):
+    # highest version both sides speak, or None if there is none
+    common = set(offered) & set(SUPPORTED_VERSIONS)
+    return max(common) if common else None
+
+
+def describe(msg_type, payload):
+    # human readable form of a frame, for logging
+    if msg_type == MSG_MOVE:
+        move = decode_move(payload)
+        return move.uci() if move else f"bad move {payload!r}"
+    if msg_type == MSG_CONTROL:
+        if len(payload) != 1:
+            return f"bad control {payload!r}"
+        return CONTROL_NAMES.get(payload[0], f"control {payload[0]}")
+    if msg_type in (MSG_TEXT, MSG_SNAPSHOT, MSG_SESSION):
+        return payload.decode()
+    return f"frame {msg_type} {payload!r}"
+
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def recv_frame(sock):
+    # blocking read of one frame, returns (type, payload) or None if the peer closed the connection
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    msg_type, length = HEADER.unpack(header)
+    payload = _recv_exactly(sock, length) if length else b""
+    if payload is None:
+        return None
+    return msg_type, payload
 
 
-def decode_move(encoded_move):
-    return encoded_move
+async def read_frame(reader):
+    # asyncio version of recv_frame
+    try:
+        msg_type, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+        payload = await reader.readexactly(length) if length else b""
+    except asyncio.IncompleteReadError:
+        return None
+    return msg_type, payload
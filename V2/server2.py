@@ -1,100 +1,508 @@
+import argparse
+import os
+import queue
+import selectors
+import shlex
 import socket
 import threading
+import time
 import chess
 import chess.engine
 
-from protocol2 import encode_move
+from admission import Admission
+from engine_pool import EnginePool
+from game_server import BotGame, GameServer
+from hot_restart import HotRestart
+from matchmaking import RelayGame, socket_alive
+from ponder import Ponderer
+from protocol2 import (MSG_CONTROL, CTRL_ACCEPTED, CTRL_BUSY, CTRL_PING, CTRL_PONG, encode_control, encode_hello,
+                       encode_text, pack_move, recv_frame, unpack_move)
+from session import GameSession, ResumeRegistry
+from spectators import SpectatorHub
 
 
-class ChessServer:
-    def __init__(self, host, port):
-        self.host = host
-        self.port = port
+class ChessServer(GameServer):
+    def __init__(self, host, port, engines=None, engine_command="stockfish", cache_size=10000, cache_file=None,
+                 book=None, pgn_log=None, archive=None, ponder=False, reuse_port=False, metrics_port=None,
+                 debug=False, spectator_buffer=4096, handshake_timeout=10.0, move_timeout=600.0,
+                 heartbeat_interval=30.0, max_games=None, queue_size=16, queue_timeout=5.0, backlog=128,
+                 engine_wait=None, resume_grace=60.0, hot_restart=None):
+        # one thread per connection and game
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.engine = chess.engine.SimpleEngine.popen_uci("stockfish")
+        if reuse_port:
+            # lets several worker processes accept on the same port (see supervisor.py)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            engine_pool = EnginePool(engines or os.cpu_count() or 1, engine_command)
+        except (OSError, chess.engine.EngineError) as e:
+            print(f"Could not start the engine ({e}), every game uses the built-in engine.")
+            engine_pool = None
+        super().__init__(host, port, engine_pool, Admission(max_games, queue_size, queue_timeout),
+                         ResumeRegistry(resume_grace), SpectatorHub(spectator_buffer), cache_size=cache_size,
+                         cache_file=cache_file, book=book, pgn_log=pgn_log, archive=archive, ponder=ponder,
+                         metrics_port=metrics_port, debug=debug, handshake_timeout=handshake_timeout,
+                         move_timeout=move_timeout, heartbeat_interval=heartbeat_interval, backlog=backlog,
+                         engine_wait=engine_wait)
+        self.connections = 0  # connection threads and games still running in this process
+        self.hot_restart = HotRestart(hot_restart) if hot_restart else None
+
+    def stats(self):
+        stats = super().stats()
+        stats["hot_restart"] = self.hot_restart.stats() if self.hot_restart else {}
+        return stats
 
-    def handle_client(self, client_socket, client_color):
+    def engine_move(self, board, limit):
+        # returns the engine's move and the reply it expects, which is what pondering searches on
+        cached = self.cached_move(board, limit)
+        if cached:
+            return cached
         try:
-            board = chess.Board()
-            if client_color == "white":
-                print("Waiting for client's move...")
-            else:
-                result = self.engine.play(board, chess.engine.Limit(time=0.5))
-                server_move = result.move
-                board.push(server_move)
-                print("Server's first move:", server_move)
-                print(board)
-                client_socket.send(encode_move(server_move).encode())
+            result, waited = self.engine_pool.play(board, limit, timeout=self.engine_wait)
+        except queue.Empty:
+            # every engine stayed busy for engine_wait seconds: a weaker move now beats a late one
+            return self.lite_move(board, limit, "saturated")
+        except chess.engine.EngineError as e:
+            print("Engine failed:", e)
+            return self.lite_move(board, limit, "no_engine")
+        return self.remember(board, limit, result, waited)
 
-            while True:
-                data = client_socket.recv(1024)
-                if not data:
-                    print("Client disconnected.")
-                    break
-                move_str = data.decode()
-                print("Received move:", move_str)
-                if move_str.lower() == "resign":
-                    print("Client resigned. Game over.")
-                    client_socket.send("resign".encode())
-                    break
-                move = chess.Move.from_uci(move_str)
-                if move and board.piece_at(move.from_square) and board.piece_at(move.from_square).color == (
-                        chess.WHITE if client_color == "white" else chess.BLACK):
-                    board.push(move)
-                    print("Client's move:", move)
-                    print(board)
-                    if board.is_checkmate():
-                        print("Checkmate! Game over.")
-                        client_socket.send("checkmate".encode())
-                        break
-                    result = self.engine.play(board, chess.engine.Limit(time=0.1))
-                    server_move = result.move
-                    board.push(server_move)
-                    print("Server's move:", server_move)
-                    print(board)
-                    if board.is_checkmate():
-                        print("Checkmate! Game over.")
-                        client_socket.send(encode_move(server_move).encode())
-                        client_socket.send("checkmate".encode())
+    def lite_move(self, board, limit, reason):
+        self.metrics.builtin_moves.inc(label_value=reason)
+        result = self.lite_engine.play(board, limit)
+        return result.move, result.ponder
+
+    def server_reply(self, board, limit, ponderer=None, level="hard"):
+        # opening book first, then a finished ponder search, then a normal engine search; games below "hard"
+        # and servers without an external engine use the built-in one
+        move = self.book_move(board)
+        if move:
+            if ponderer:
+                ponderer.cancel()
+            return move, None
+        if ponderer:
+            best = ponderer.resolve(board.peek() if board.move_stack else None, limit)
+            if best:
+                return self.remember(board, limit, best)
+        reason = self.builtin_reason(level)
+        if reason:
+            return self.lite_move(board, limit, reason)
+        return self.engine_move(board, limit)
+
+    def receive_move_frame(self, client_socket, heartbeat):
+        # waits for the client's next frame and pings it while it is silent; None if it disconnected,
+        # stopped answering or ran out of time to move (heartbeat.expired says which)
+        heartbeat.start_move()
+        while True:
+            try:
+                if heartbeat.check():
+                    client_socket.sendall(encode_control(CTRL_PING))
+            except OSError:
+                return None
+            if heartbeat.expired:
+                return None
+            timeout = heartbeat.next_check()
+            if self.hot_restart:
+                if not self.hot_restart.wait(client_socket, timeout):
+                    continue
+                if self.hot_restart.handing_off:
+                    return None  # the caller hands the game over
+            client_socket.settimeout(None if timeout is None else max(timeout, 0.01))
+            try:
+                if not client_socket.recv(1, socket.MSG_PEEK):
+                    return None
+            except socket.timeout:
+                continue
+            except OSError:
+                return None  # reset by the client
+            client_socket.settimeout(self.handshake_timeout)  # the rest of a frame follows right away
+            try:
+                frame = recv_frame(client_socket)
+            except OSError:
+                return None
+            heartbeat.seen()
+            if frame != (MSG_CONTROL, bytes([CTRL_PONG])):
+                return frame
+
+    def handle_client(self, client_socket, client_color, version, level="hard", session=None, token=None,
+                      started=None):
+        # session, token and started are given for a game handed over by another process, whose client socket is
+        # None if it was waiting for its client to resume
+        def send(data):
+            # a failed write is noticed by the next read, which is where a dropped client gets to resume
+            if data:
+                try:
+                    client_socket.sendall(data)
+                except OSError:
+                    pass
+
+        metrics = self.metrics
+        game = BotGame(self, client_color, version, level, session, token, started)
+        handed_off = False
+        ponderer = Ponderer(self.engine_pool) if self.ponder and self.engine_pool and level == "hard" else None
+        try:
+            data, board = game.opening()
+            send(data)
+            if board:
+                with metrics.engine_seconds.time():
+                    server_move, expected_reply = self.server_reply(board, game.first_move_limit, level=level)
+                data = game.on_reply(board, server_move)
+                with metrics.send_seconds.time():
+                    send(data)
+                if ponderer:
+                    ponderer.start(board, expected_reply, game.reply_limit)
+
+            while not game.over:
+                board = None  # only the compact session is kept while waiting for the client
+                frame = None
+                if client_socket:
+                    with metrics.recv_seconds.time():
+                        frame = self.receive_move_frame(client_socket, game.heartbeat)
+                if frame is None and self.hot_restart and self.hot_restart.handing_off and not game.heartbeat.expired:
+                    if self.hot_restart.send(game.state(), [client_socket] if client_socket else []):
+                        handed_off = True
                         break
-                    client_socket.send(encode_move(server_move).encode())
-                else:
-                    print("Invalid move from client.")
-                    client_socket.send("Invalid".encode())
+                    continue  # the hand-off is over, this process keeps the game
+                if frame is None and game.may_resume():
+                    if client_socket:
+                        print("Client disconnected, holding the game for it to resume.")
+                        client_socket.close()
+                        client_socket = None
+                    if ponderer:
+                        ponderer.cancel()
+                    resumed = self.resumable.wait(game.token)
+                    if resumed is False:
+                        continue  # woken to be handed over
+                    if resumed:
+                        client_socket, ply = resumed
+                        send(game.on_resume(ply))
+                        continue
+                if frame is None:
+                    send(game.on_lost())
+                    break
+                data, board = game.on_frame(frame)
+                send(data)
+                if board is None:
+                    continue
+                with metrics.engine_seconds.time():
+                    server_move, expected_reply = self.server_reply(board, game.reply_limit, ponderer, level)
+                data = game.on_reply(board, server_move)
+                with metrics.send_seconds.time():
+                    send(data)
+                if ponderer and not game.over:
+                    ponderer.start(board, expected_reply, game.reply_limit)
         except Exception as e:
             print("Exception occurred:", e)
         finally:
+            if ponderer:
+                ponderer.cancel()
+            if client_socket:
+                client_socket.close()
+            game.finish(handed_off)
+
+    def match_player(self, client_socket, client_color, version, adopted=False):
+        # human games never touch the engine: pair two clients and relay their moves
+        pair = self.match_queue.join((client_socket, version), client_color, alive=self.waiting_alive)
+        if pair is None:
+            print(f"Waiting for an opponent ({self.match_queue.depth()}).")
+            if not adopted:
+                client_socket.sendall(encode_text("Waiting for an opponent."))
+            return
+        threading.Thread(target=self.counted, args=(self.relay_game, *pair)).start()
+
+    def waiting_alive(self, player):
+        if socket_alive(player[0]):
+            return True
+        player[0].close()
+        return False
+
+    def relay_game(self, white, black, moves=(), started=None):
+        # moves and started are given for a game handed over by another process
+        game = RelayGame(self.legal_moves)
+        for value in moves:
+            game.board.push(unpack_move(value))
+        adopted = started is not None
+        started = started or time.time()
+        handed_off = False
+        game_id, heartbeats = self.open_relay(game, (white[1], black[1]), adopted)
+        sockets = {chess.WHITE: white[0], chess.BLACK: black[0]}
+
+        def send(outputs):
+            for target, data in outputs:
+                try:
+                    sockets[target].sendall(data)
+                except OSError:
+                    pass
+
+        try:
+            if not adopted:
+                send(self.opponent_found())
+            with selectors.DefaultSelector() as selector:
+                for color, sock in sockets.items():
+                    selector.register(sock, selectors.EVENT_READ, color)
+                if self.hot_restart:
+                    selector.register(self.hot_restart.wakeup, selectors.EVENT_READ)
+                while not game.over:
+                    if self.hot_restart and self.hot_restart.handing_off:
+                        state = {"kind": "relay", "versions": [white[1], black[1]], "started": started,
+                                 "moves": [pack_move(move) for move in game.board.move_stack]}
+                        if self.hot_restart.send(state, [white[0], black[0]]):
+                            handed_off = True
+                            break
+                    for key, _ in selector.select(self.relay_timeout(heartbeats)):
+                        if key.data is None:
+                            continue  # woken for a hot restart
+                        try:
+                            frame = recv_frame(key.fileobj)
+                        except OSError:
+                            frame = None
+                        send(self.relay_frame(game, game_id, heartbeats, key.data, frame))
+                        if game.over:
+                            break
+                    send(self.relay_heartbeats(game, heartbeats))
+        finally:
+            for sock in sockets.values():
+                sock.close()
+            self.finish_relay(game, game_id, started, handed_off)
+
+    def watch_game(self, client_socket, game_id):
+        if not (game_id and game_id.isdigit() and self.spectators.watch(client_socket, int(game_id))):
+            client_socket.sendall(self.spectators.listing())
+            client_socket.close()
+
+    def resume_game(self, client_socket, request):
+        # request is "<token>:<plies the client has>"; the game waiting for that token takes the connection
+        # over and sends the catch-up itself
+        token, _, ply = (request or "").partition(":")
+        if ply.isdigit() and self.resumable.resume(token, client_socket, int(ply)):
+            return
+        client_socket.sendall(encode_text("Unknown or expired session."))
+        client_socket.close()
+
+    def handshake(self, client_socket):
+        # agree on a protocol version, then read the opponent and color choices (spectators send "watch"
+        # and a game id instead); the color is accepted by the caller once the game has a slot
+        client_socket.sendall(encode_hello())
+        version = self.read_version(recv_frame(client_socket))
+        if version is None:
+            client_socket.sendall(encode_text("Unsupported protocol version."))
+            return None
+        opponent = self.read_opponent(self.read_text(recv_frame(client_socket)))
+        if opponent is None:
+            client_socket.sendall(encode_text("Invalid opponent choice."))
+            return None
+        client_socket.sendall(encode_control(CTRL_ACCEPTED))
+        choice = self.read_choice(*opponent, self.read_text(recv_frame(client_socket)), version)
+        if choice is None:
+            client_socket.sendall(encode_text("Invalid color choice."))
+        return choice
+
+    def serve_connection(self, client_socket):
+        # runs on its own thread, so a slow handshake never holds up the accept loop
+        try:
+            client_socket.settimeout(self.handshake_timeout)
+            choice = self.handshake(client_socket)
+            if choice is None:
+                client_socket.close()
+                return
+            opponent, color, version, level = choice
+            if opponent == "watch":
+                self.watch_game(client_socket, color)
+                return
+            if opponent == "resume":
+                self.resume_game(client_socket, color)
+                return
+            if opponent == "human":
+                client_socket.sendall(encode_control(CTRL_ACCEPTED))
+                client_socket.settimeout(None)
+                self.match_player(client_socket, color, version)
+                return
+            if not self.admission.acquire():
+                self.metrics.busy_rejections.inc()
+                client_socket.sendall(encode_control(CTRL_BUSY))
+                client_socket.close()
+                return
+        except Exception as e:  # anything a malformed handshake raises, so the client is never left hanging
+            print("Handshake failed:", e)
             client_socket.close()
+            return
+        try:
+            client_socket.sendall(encode_control(CTRL_ACCEPTED))
+            self.handle_client(client_socket, color, version, level)
+        except Exception as e:
+            print("Exception occurred:", e)
+            client_socket.close()
+        finally:
+            self.admission.release()
+
+    def counted(self, target, *args, **kwargs):
+        # runs a connection or game, keeping count so a process that handed over to a newer one knows when
+        # it is done
+        with self._games_lock:
+            self.connections += 1
+        try:
+            target(*args, **kwargs)
+        finally:
+            with self._games_lock:
+                self.connections -= 1
+
+    def hand_off(self):
+        # a newer server connected on the hot restart path: give it the listener, then each game as it next
+        # waits for a client (parked games and players waiting for an opponent straight away)
+        if not self.hot_restart.begin(self.server_socket):
+            return
+        print("Handing the listener and live games to the new server.")
+        if self.metrics_server:
+            self.metrics_server.stop()  # the new server takes the port over once it has every game
+        deadline = time.monotonic() + 30
+        while True:
+            self.resumable.release()
+            for (client_socket, version), color in self.match_queue.drain():
+                state = {"kind": "waiting", "color": color, "version": version}
+                if self.hot_restart.send(state, [client_socket]):
+                    client_socket.close()
+                else:
+                    self.match_player(client_socket, color, version, adopted=True)  # the hand-off failed: wait here
+            with self._games_lock:
+                connections = self.connections
+            if not connections or time.monotonic() > deadline or not self.hot_restart.handing_off:
+                break
+            time.sleep(0.1)
+        print(f"Handed over {self.hot_restart.handed_off} games and players, {connections} left to finish here.")
+        if self.engine_cache and self.engine_cache.path:
+            self.engine_cache.save()  # the new server merges it once it has every game
+        self.hot_restart.finish()
+
+    def adopt_games(self):
+        # the previous server sends its games until it has nothing left; then wait for the next deploy
+        while True:
+            try:
+                message, sockets = self.hot_restart.receive()
+            except OSError:
+                break
+            if message is None:
+                break
+            kind = message["kind"]
+            if kind == "game":
+                session = GameSession()
+                session.load(message["moves"])
+                threading.Thread(target=self.counted, daemon=True, args=(
+                    self.handle_client, sockets[0] if sockets else None, message["color"], message["version"],
+                    message["level"]), kwargs={"session": session, "token": message["token"],
+                                               "started": message["started"]}).start()
+            elif kind == "relay":
+                white, black = zip(sockets, message["versions"])
+                threading.Thread(target=self.counted, args=(self.relay_game, white, black, message["moves"],
+                                                            message["started"])).start()
+            elif kind == "waiting":
+                self.match_player(sockets[0], message["color"], message["version"], adopted=True)
+        print(f"Took over {self.hot_restart.adopted} games and players.")
+        self.hot_restart.close()
+        if self.engine_cache and self.engine_cache.path and os.path.exists(self.engine_cache.path):
+            self.engine_cache.load(self.engine_cache.path)  # what the old server learned since this one started
+        if self.metrics_server:
+            self.metrics_server.start()
+        self.hot_restart.listen(self.hand_off)
 
     def start(self):
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-        print(f"Server listening on {self.host}:{self.port}")
+        listener = self.hot_restart.take_over() if self.hot_restart else None
+        if listener:
+            self.server_socket.close()
+            self.server_socket = listener
+            print(f"Took over the listener on {self.host}:{self.port} from the previous server.")
+            threading.Thread(target=self.adopt_games, daemon=True).start()
+        else:
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen(self.backlog)
+            print(f"Server listening on {self.host}:{self.port}")
+            if self.hot_restart:
+                self.server_socket.setblocking(False)  # both processes accept on it while handing over
+                self.hot_restart.listen(self.hand_off)
+            if self.metrics_server:
+                self.metrics_server.start()
         try:
             while True:
-                client_socket, _ = self.server_socket.accept()
-                client_socket.send("Ready".encode())
-                client_response = client_socket.recv(1024).decode().lower()
-                if client_response not in ["bot", "human"]:
-                    client_socket.send("Invalid opponent choice.".encode())
-                    client_socket.close()
+                if self.hot_restart:
+                    client_socket = self.hot_restart.accept(self.server_socket)
+                    if client_socket is None:
+                        break
                 else:
-                    client_socket.send("Accepted".encode())
-                    client_color_response = client_socket.recv(1024).decode().lower()
-                    if client_color_response not in ["white", "black"]:
-                        client_socket.send("Invalid color choice.".encode())
-                        client_socket.close()
-                    else:
-                        client_socket.send("Accepted".encode())
-                        client_thread = threading.Thread(target=self.handle_client, args=(
-                            client_socket, client_color_response))
-                        client_thread.start()
+                    client_socket, _ = self.server_socket.accept()
+                threading.Thread(target=self.counted, args=(self.serve_connection, client_socket), daemon=True).start()
+            while self.connections or self.hot_restart.handing_off:
+                time.sleep(0.1)  # the games that could not be handed over finish here
+            print("Handed over to the new server, shutting down.")
         except KeyboardInterrupt:
             print("Server shutting down.")
         finally:
             self.server_socket.close()
+            if self.metrics_server:
+                self.metrics_server.stop()
+            if self.engine_cache and self.engine_cache.path:
+                self.engine_cache.save()
+            if self.opening_book:
+                self.opening_book.close()
+            if self.archive:
+                self.archive.close()
+            self.spectators.close()
+            if self.engine_pool:
+                self.engine_pool.close()
 
 
 if __name__ == "__main__":
-    server = ChessServer('localhost', 5555)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--engines", type=int, default=None, help="size of the engine pool (default: CPU count)")
+    parser.add_argument("--engine-command", default="stockfish", help='e.g. "python3 fake_engine.py" for benchmarks')
+    parser.add_argument("--engine-wait", type=float, default=None,
+                        help="play the built-in engine's move when no engine is free within this many seconds")
+    parser.add_argument("--cache-size", type=int, default=10000, help="engine replies to remember (0 disables)")
+    parser.add_argument("--cache-file", default=None, help="load the reply cache from and save it to this file")
+    parser.add_argument("--book", default=None, help="Polyglot opening book to play from before using the engine")
+    parser.add_argument("--pgn-log", default=None, help="append finished games to this PGN file")
+    parser.add_argument("--archive", default=None,
+                        help="append finished games to this binary archive (see game_archive.py)")
+    parser.add_argument("--ponder", action="store_true", help="search the expected reply while the client thinks")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve /metrics (Prometheus text) and /stats (JSON) on this localhost port")
+    parser.add_argument("--spectator-buffer", type=int, default=4096,
+                        help="bytes queued for a spectator before it is skipped ahead to the current position")
+    parser.add_argument("--handshake-timeout", type=float, default=10.0,
+                        help="seconds a client has for the handshake")
+    parser.add_argument("--move-timeout", type=float, default=600.0,
+                        help="seconds a client has for each move before it loses the game (0 disables)")
+    parser.add_argument("--heartbeat-interval", type=float, default=30.0,
+                        help="ping a silent client after this many seconds and drop it if it does not answer")
+    parser.add_argument("--max-games", type=int, default=None,
+                        help="bot games that may run at once (default: no limit)")
+    parser.add_argument("--queue-size", type=int, default=16, help="clients that may wait for a game slot")
+    parser.add_argument("--queue-timeout", type=float, default=5.0,
+                        help="seconds a waiting client gets a slot in before it is told the server is busy")
+    parser.add_argument("--backlog", type=int, default=128, help="listen backlog for connections not yet accepted")
+    parser.add_argument("--resume-grace", type=float, default=60.0,
+                        help="seconds a bot game waits for its client to reconnect after a disconnect (0 disables)")
+    parser.add_argument("--hot-restart", default=None, metavar="PATH",
+                        help="take over the listener and live games from the server running with the same Unix "
+                             "socket path, and hand them to the next one started with it")
+    parser.add_argument("--debug", action="store_true", help="print the board after every move")
+    parser.add_argument("--workers", type=int, default=1, help="run this many server processes on the same port")
+    parser.add_argument("--asyncio", action="store_true", help="serve every game from one asyncio event loop")
+    args = parser.parse_args()
+    if args.hot_restart and (args.workers > 1 or args.asyncio):
+        parser.error("--hot-restart only works with a single threaded server")
+    options = dict(engines=args.engines, engine_command=shlex.split(args.engine_command), cache_size=args.cache_size,
+                   cache_file=args.cache_file, book=args.book, pgn_log=args.pgn_log,
+                   archive=args.archive, ponder=args.ponder, metrics_port=args.metrics_port, debug=args.debug,
+                   spectator_buffer=args.spectator_buffer, handshake_timeout=args.handshake_timeout,
+                   move_timeout=args.move_timeout, heartbeat_interval=args.heartbeat_interval, max_games=args.max_games,
+                   queue_size=args.queue_size, queue_timeout=args.queue_timeout, backlog=args.backlog,
+                   engine_wait=args.engine_wait, resume_grace=args.resume_grace)
+    if args.workers > 1:
+        from supervisor import Supervisor
+        server = Supervisor(args.host, args.port, args.workers, options, args.asyncio)
+    elif args.asyncio:
+        from async_server2 import AsyncChessServer
+        server = AsyncChessServer(args.host, args.port, **options)
+    else:
+        server = ChessServer(args.host, args.port, hot_restart=args.hot_restart, **options)
     server.start()
@@ -0,0 +1,168 @@
+import asyncio
+import secrets
+import threading
+from array import array
+
+import chess
+import chess.polyglot
+
+from protocol2 import pack_move, unpack_move
+
+
+class GameSession:
+    # what a game keeps between moves: the position after the last irreversible move (capture or pawn move)
+    # as bitboards, the current Zobrist key and the moves as 16-bit values. A chess.Board (with its move stack
+    # and per-move undo states) is only built while a move is being handled, so an idle game costs a few
+    # hundred bytes instead of tens of kilobytes
+    __slots__ = ("bitboards", "turn", "castling_rights", "ep_square", "halfmove_clock", "fullmove_number", "key",
+                 "moves", "reversible")
+
+    def __init__(self):
+        self.moves = array("H")
+        self.reversible = 0  # moves played since the stored position
+        self.store(chess.Board())
+
+    def store(self, board):
+        self.bitboards = array("Q", (board.pawns, board.knights, board.bishops, board.rooks, board.queens,
+                                     board.kings, board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK]))
+        self.turn = board.turn
+        self.castling_rights = board.castling_rights
+        self.ep_square = board.ep_square
+        self.halfmove_clock = board.halfmove_clock
+        self.fullmove_number = board.fullmove_number
+        self.key = chess.polyglot.zobrist_hash(board)
+
+    def board(self):
+        # the current position, with the moves since the last irreversible one on its stack: enough history
+        # for repetitions, which no earlier position can be part of. Moves pushed on it are not recorded until
+        # push() is used
+        board = chess.Board(None)
+        (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings,
+         white, black) = self.bitboards
+        board.occupied_co[chess.WHITE] = white
+        board.occupied_co[chess.BLACK] = black
+        board.occupied = white | black
+        board.turn = self.turn
+        board.castling_rights = self.castling_rights
+        board.ep_square = self.ep_square
+        board.halfmove_clock = self.halfmove_clock
+        board.fullmove_number = self.fullmove_number
+        for value in self.moves[len(self.moves) - self.reversible:]:
+            board.push(unpack_move(value))
+        return board
+
+    def push(self, board, move):
+        # plays the move on a board from board() and records it
+        board.push(move)
+        self.moves.append(pack_move(move))
+        if board.halfmove_clock:
+            self.reversible += 1
+            self.key = chess.polyglot.zobrist_hash(board)
+        else:
+            self.reversible = 0
+            self.store(board)
+
+    def load(self, moves):
+        # restores a game from its 16-bit moves, for a game handed over by another server process
+        for value in moves:
+            self.push(self.board(), unpack_move(value))
+
+    def last_move(self):
+        return unpack_move(self.moves[-1]) if self.moves else None
+
+    def ply(self):
+        return len(self.moves)
+
+    def catch_up(self, ply):
+        # for a client that resumes after `ply` plies: the position it should have and the moves it missed
+        ply = min(max(ply, 0), len(self.moves))
+        board = chess.Board()
+        for value in self.moves[:ply]:
+            board.push(unpack_move(value))
+        return board, [unpack_move(value) for value in self.moves[ply:]]
+
+    def replay(self):
+        # the full game with its move stack, for saving and results at the end of the game
+        board = chess.Board()
+        for value in self.moves:
+            board.push(unpack_move(value))
+        return board
+
+
+class ResumeRegistry:
+    def __init__(self, grace=60.0):
+        # games whose client dropped wait here for up to `grace` seconds; a client that reconnects with the
+        # game's token hands its new connection to the waiting game, which carries on where it stopped
+        self.grace = grace
+        self._condition = threading.Condition()
+        self._waiting = {}  # token -> None, or the (connection, ply) of the client that came back
+        self.parked = 0
+        self.resumed = 0
+        self.abandoned = 0
+
+    def new_token(self):
+        return secrets.token_hex(16)
+
+    def wait(self, token):
+        # called by the game; returns (connection, ply the client has), None once the grace period is over or
+        # False if release() was called
+        with self._condition:
+            self._waiting[token] = None
+            self.parked += 1
+            self._condition.wait_for(lambda: self._waiting[token] is not None, self.grace)
+            resumed = self._waiting.pop(token)
+            if resumed:
+                self.resumed += 1
+            elif resumed is None:
+                self.abandoned += 1
+            return resumed
+
+    def resume(self, token, connection, ply):
+        # called for the reconnecting client; False if no game is waiting for this token
+        with self._condition:
+            if self._waiting.get(token, True) is not None:
+                return False
+            self._waiting[token] = (connection, ply)
+            self._condition.notify_all()
+            return True
+
+    def release(self):
+        # wakes every waiting game with False instead of a connection, so it can be handed to another process
+        with self._condition:
+            for token, resumed in self._waiting.items():
+                if resumed is None:
+                    self._waiting[token] = False
+            self._condition.notify_all()
+
+    def stats(self):
+        return {"waiting": len(self._waiting), "parked": self.parked, "resumed": self.resumed,
+                "abandoned": self.abandoned}
+
+
+class AsyncResumeRegistry(ResumeRegistry):
+    def __init__(self, grace=60.0):
+        # asyncio version; the waiting game awaits a future that resume() completes
+        super().__init__(grace)
+
+    async def wait(self, token):
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[token] = future
+        self.parked += 1
+        try:
+            resumed = await asyncio.wait_for(future, self.grace)
+        except asyncio.TimeoutError:
+            resumed = None
+        finally:
+            del self._waiting[token]
+        if resumed:
+            self.resumed += 1
+        else:
+            self.abandoned += 1
+        return resumed
+
+    def resume(self, token, connection, ply):
+        future = self._waiting.get(token)
+        if future is None or future.done():
+            return False
+        future.set_result((connection, ply))
+        return True
@@ -0,0 +1,52 @@
+import argparse
+import socket
+
+import chess
+
+from protocol2 import (MSG_CONTROL, MSG_HELLO, MSG_MOVE, MSG_SNAPSHOT, MSG_TEXT, CTRL_ACCEPTED, decode_move,
+                       encode_hello, encode_text, negotiate_version, recv_frame)
+
+
+def watch(host, port, game_id):
+    # prints the board of a live game after every move; an unknown id prints the live game ids
+    with socket.create_connection((host, port)) as sock:
+        frame = recv_frame(sock)
+        version = negotiate_version(frame[1]) if frame and frame[0] == MSG_HELLO else None
+        if version is None:
+            print("No common protocol version.")
+            return
+        sock.sendall(encode_hello((version,)))
+        sock.sendall(encode_text("watch"))
+        if recv_frame(sock) != (MSG_CONTROL, bytes([CTRL_ACCEPTED])):
+            print("Server does not support spectators.")
+            return
+        sock.sendall(encode_text(str(game_id)))
+        board = None
+        while True:
+            frame = recv_frame(sock)
+            if frame is None:
+                return
+            msg_type, payload = frame
+            if msg_type == MSG_SNAPSHOT:
+                # sent when joining, and again if we fell too far behind to get every move
+                board = chess.Board(payload.decode())
+            elif msg_type == MSG_MOVE and board is not None:
+                move = decode_move(payload)
+                print(board.san(move))
+                board.push(move)
+            elif msg_type == MSG_TEXT:
+                print(payload.decode())
+                continue
+            else:
+                continue
+            print(board)
+            print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch a live game on the V2 chess server.")
+    parser.add_argument("game_id", nargs="?", default="", help="game to watch (leave out to list live games)")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5555)
+    args = parser.parse_args()
+    watch(args.host, args.port, args.game_id)
@@ -0,0 +1,323 @@
+import asyncio
+import itertools
+import selectors
+import socket
+import threading
+from array import array
+from collections import deque
+
+import chess
+
+from protocol2 import CTRL_ACCEPTED, encode_control, encode_move, encode_snapshot, encode_text, pack_move, unpack_move
+
+
+class Watcher:
+    def __init__(self, target, max_buffer, max_skips):
+        # bounded queue of frames for one spectator; a frame that does not fit throws away what the
+        # spectator has not started receiving and queues a snapshot of the position instead
+        self.target = target
+        self.max_buffer = max_buffer
+        self.max_skips = max_skips
+        self.frames = deque()
+        self.offset = 0  # bytes of frames[0] already sent
+        self.buffered = 0
+        self.skips = 0
+        self.dropped = False
+        self.closing = False
+
+    def push(self, data, snapshot):
+        # returns False once the spectator has fallen behind too often and should be dropped
+        if self.buffered + len(data) <= self.max_buffer:
+            self.frames.append(data)
+            self.buffered += len(data)
+            return True
+        self.skips += 1
+        if self.skips > self.max_skips:
+            return False
+        partial = self.frames[0] if self.offset else None  # a half sent frame has to be finished
+        self.frames.clear()
+        if partial is not None:
+            self.frames.append(partial)
+        self.frames.append(snapshot())
+        self.buffered = sum(len(frame) for frame in self.frames) - self.offset
+        return True
+
+    def sent(self, count):
+        self.buffered -= count
+        self.offset += count
+        if self.offset == len(self.frames[0]):
+            self.frames.popleft()
+            self.offset = 0
+
+
+class Broadcast:
+    # a live game as spectators see it. Every game has one whether or not anyone watches, so it only keeps the
+    # moves as 16-bit values; a chess.Board is built when the first spectator arrives and kept while any watch
+    __slots__ = ("game_id", "start_fen", "moves", "board", "watchers", "_snapshot")
+
+    def __init__(self, game_id, board):
+        self.game_id = game_id
+        root = board.root()
+        self.start_fen = None if root.fen() == chess.STARTING_FEN else root.fen()
+        self.moves = array("H", (pack_move(move) for move in board.move_stack))
+        self.board = None
+        self.watchers = []
+        self._snapshot = None
+
+    def push(self, move):
+        self.moves.append(pack_move(move))
+        if self.board is not None:
+            self.board.push(move)
+
+    def watched(self):
+        # called when a spectator arrives; builds the board if nobody was watching
+        if self.board is None:
+            self.board = chess.Board(self.start_fen or chess.STARTING_FEN)
+            for value in self.moves:
+                self.board.push(unpack_move(value))
+
+    def unwatched(self):
+        # called when a spectator leaves; the board goes when the last one does
+        if not self.watchers:
+            self.board = None
+            self._snapshot = None
+
+    def snapshot(self):
+        # encoded at most once per position, however many spectators need it
+        if self._snapshot is None or self._snapshot[0] != len(self.moves):
+            self._snapshot = (len(self.moves), encode_snapshot(self.board))
+        return self._snapshot[1]
+
+
+class SpectatorRegistry:
+    def __init__(self, max_buffer=4096, max_skips=5):
+        # live games by id; every move is encoded once and the same bytes are queued for each spectator
+        self.max_buffer = max_buffer
+        self.max_skips = max_skips
+        self._games = {}
+        self._watchers = set()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.skipped = 0
+        self.dropped = 0
+
+    def open_game(self, board):
+        with self._lock:
+            game_id = next(self._ids)
+            self._games[game_id] = Broadcast(game_id, board)
+        return game_id
+
+    def live_games(self, limit=None):
+        # (the ids of the `limit` oldest live games, how many are live); ids only grow, so the dict is in id order
+        with self._lock:
+            return list(itertools.islice(self._games, limit)), len(self._games)
+
+    def listing(self, limit=1000):
+        # the reply to an unknown id; a text frame holds 65535 bytes, which the full list outgrows at about
+        # 9,000 games, so only the oldest `limit` ids are listed along with the total
+        ids, total = self.live_games(limit)
+        if not ids:
+            return encode_text("Live games: none")
+        shown = f" (first {len(ids)} of {total})" if total > len(ids) else ""
+        return encode_text(f"Live games{shown}: {', '.join(map(str, ids))}")
+
+    def publish(self, game_id, move):
+        self._send(game_id, move=move)
+
+    def finish(self, game_id, result):
+        self._send(game_id, data=encode_text(f"Game over: {result}"), final=True)
+
+    def _send(self, game_id, move=None, data=b"", final=False):
+        with self._lock:
+            game = self._games.pop(game_id, None) if final else self._games.get(game_id)
+            if game is None or (not game.watchers and not final):
+                if game and move:
+                    game.push(move)
+                return
+            if move:
+                game.push(move)
+                data = encode_move(move) + data
+            watchers = list(game.watchers)
+            for watcher in watchers:
+                skips = watcher.skips
+                if not watcher.push(data, game.snapshot):
+                    watcher.dropped = True
+                    game.watchers.remove(watcher)
+                    game.unwatched()
+                    self.dropped += 1
+                elif watcher.skips != skips:
+                    self.skipped += 1
+                if final:
+                    watcher.closing = True
+        self._notify(watchers)
+
+    def _add(self, target, game_id):
+        # the accepted frame and the snapshot are the first things every spectator gets
+        with self._lock:
+            game = self._games.get(game_id)
+            if game is None:
+                return None
+            watcher = Watcher(target, self.max_buffer, self.max_skips)
+            game.watched()
+            watcher.push(encode_control(CTRL_ACCEPTED) + game.snapshot(), game.snapshot)
+            game.watchers.append(watcher)
+            self._watchers.add(watcher)
+        self._notify([watcher])
+        return watcher
+
+    def _remove(self, watcher):
+        with self._lock:
+            self._watchers.discard(watcher)
+            for game in self._games.values():
+                if watcher in game.watchers:
+                    game.watchers.remove(watcher)
+                    game.unwatched()
+
+    def _notify(self, watchers):
+        pass
+
+    def stats(self):
+        with self._lock:
+            return {"games": len(self._games), "watchers": len(self._watchers), "skipped": self.skipped,
+                    "dropped": self.dropped}
+
+
+class SpectatorHub(SpectatorRegistry):
+    def __init__(self, max_buffer=4096, max_skips=5):
+        # all spectator sockets are non-blocking and written by one selector thread, so a slow
+        # spectator never holds up a game thread
+        super().__init__(max_buffer, max_skips)
+        self._selector = selectors.DefaultSelector()
+        self._wakeup, self._wakeup_sender = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        self._registered = {}
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="spectators", daemon=True)
+        self._thread.start()
+
+    def watch(self, client_socket, game_id):
+        client_socket.setblocking(False)
+        if self._add(client_socket, game_id) is None:
+            client_socket.setblocking(True)
+            return False
+        return True
+
+    def _notify(self, watchers):
+        try:
+            self._wakeup_sender.send(b"\0")
+        except OSError:
+            pass  # a wakeup is already pending
+
+    def _discard(self, watcher):
+        self._remove(watcher)
+        if watcher in self._registered:
+            self._selector.unregister(watcher.target)
+            del self._registered[watcher]
+        watcher.target.close()
+
+    def _flush(self, watcher):
+        with self._lock:
+            while watcher.frames:
+                try:
+                    sent = watcher.target.send(memoryview(watcher.frames[0])[watcher.offset:])
+                except BlockingIOError:
+                    return
+                except OSError:
+                    watcher.dropped = True
+                    return
+                watcher.sent(sent)
+
+    def _run(self):
+        while not self._closed:
+            with self._lock:
+                watchers = list(self._watchers)
+            for watcher in watchers:
+                if watcher.dropped or (watcher.closing and not watcher.frames):
+                    self._discard(watcher)
+                    continue
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if watcher.frames else 0)
+                if watcher not in self._registered:
+                    self._selector.register(watcher.target, events, watcher)
+                elif self._registered[watcher] != events:
+                    self._selector.modify(watcher.target, events, watcher)
+                self._registered[watcher] = events
+            for key, events in self._selector.select():
+                watcher = key.data
+                if watcher is None:
+                    try:
+                        self._wakeup.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                if events & selectors.EVENT_READ:
+                    try:
+                        if not watcher.target.recv(4096):
+                            watcher.dropped = True  # spectator hung up
+                    except BlockingIOError:
+                        pass
+                    except OSError:
+                        watcher.dropped = True
+                if events & selectors.EVENT_WRITE and not watcher.dropped:
+                    self._flush(watcher)
+
+    def close(self):
+        self._closed = True
+        self._notify([])
+        self._thread.join()
+        for watcher in list(self._registered):
+            self._discard(watcher)
+        self._selector.close()
+        self._wakeup.close()
+        self._wakeup_sender.close()
+
+
+class AsyncSpectatorHub(SpectatorRegistry):
+    def __init__(self, max_buffer=4096, max_skips=5):
+        # asyncio version: one writer coroutine per spectator, woken when frames are queued
+        super().__init__(max_buffer, max_skips)
+        self._ready = {}
+
+    async def watch(self, reader, writer, game_id):
+        # serves the spectator until the game ends or it disconnects; False if the game does not exist
+        watcher = self._add(writer, game_id)
+        if watcher is None:
+            return False
+        self._ready[watcher] = asyncio.Event()
+        self._ready[watcher].set()
+        tasks = [asyncio.ensure_future(self._wait_hangup(reader)), asyncio.ensure_future(self._write(watcher))]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            del self._ready[watcher]
+            self._remove(watcher)
+        return True
+
+    async def _wait_hangup(self, reader):
+        # spectators have nothing to say, so anything they send is read and ignored
+        while await reader.read(4096):
+            pass
+
+    async def _write(self, watcher):
+        writer = watcher.target
+        while not watcher.dropped:
+            await self._ready[watcher].wait()
+            self._ready[watcher].clear()
+            while True:
+                with self._lock:
+                    if not watcher.frames:
+                        break
+                    frame = watcher.frames[0]
+                    watcher.sent(len(frame))
+                writer.write(frame)
+                await writer.drain()
+            if watcher.closing:
+                return
+
+    def _notify(self, watchers):
+        for watcher in watchers:
+            if watcher in self._ready:
+                self._ready[watcher].set()
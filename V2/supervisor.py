@@ -0,0 +1,129 @@
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+
+from metrics import MetricsServer
+
+
+def merge_stats(reports):
+    # sums the workers' counters; max_* keys keep the largest value and avg_*/hit_rate keys are averaged
+    merged = {}
+    for key in {key for report in reports for key in report}:
+        values = [report[key] for report in reports if key in report]
+        if isinstance(values[0], dict):
+            merged[key] = merge_stats(values)
+        elif key.startswith("max") or key.startswith("oldest"):
+            merged[key] = max(values)
+        elif key.startswith("avg") or key.endswith("rate"):
+            merged[key] = sum(values) / len(values)
+        else:
+            merged[key] = sum(values)
+    return merged
+
+
+def run_worker(index, host, port, options, use_asyncio, stats_queue, report_interval):
+    # each worker is a full server with its own engines, accepting on the shared port via SO_REUSEPORT
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if options.get("metrics_port"):
+        # the supervisor keeps the configured port for the merged stats, workers take the ports after it
+        options = dict(options, metrics_port=options["metrics_port"] + 1 + index)
+    if options.get("archive"):
+        # one archive per worker, so processes never interleave their buffered appends
+        options = dict(options, archive=f"{options['archive']}.{index}")
+    if use_asyncio:
+        from async_server2 import AsyncChessServer
+        server = AsyncChessServer(host, port, reuse_port=True, **options)
+    else:
+        from server2 import ChessServer
+        server = ChessServer(host, port, reuse_port=True, **options)
+
+    def report():
+        while True:
+            time.sleep(report_interval)
+            try:
+                stats_queue.put_nowait((index, os.getpid(), server.stats()))
+            except (queue.Full, ValueError, OSError):
+                pass
+
+    threading.Thread(target=report, daemon=True).start()
+    server.start()
+
+
+class Supervisor:
+    def __init__(self, host, port, workers, options, use_asyncio=False, report_interval=5.0):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("--workers needs SO_REUSEPORT, which this platform does not support")
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.options = dict(options)
+        if not self.options.get("engines"):
+            # split the cores between workers instead of giving every worker one engine per core
+            self.options["engines"] = max(1, (os.cpu_count() or 1) // workers)
+        self.use_asyncio = use_asyncio
+        self.report_interval = report_interval
+        self.stats_queue = multiprocessing.Queue(maxsize=workers * 4)
+        self.processes = {}
+        self.reports = {}
+        self.restarts = 0
+        metrics_port = self.options.get("metrics_port")
+        self.metrics_server = MetricsServer("localhost", metrics_port, stats=self.stats) if metrics_port else None
+
+    def spawn(self, index):
+        process = multiprocessing.Process(target=run_worker, name=f"chess-worker-{index}", args=(
+            index, self.host, self.port, self.options, self.use_asyncio, self.stats_queue, self.report_interval))
+        process.start()
+        self.processes[index] = process
+        print(f"Started worker {index} (pid {process.pid})")
+
+    def collect(self):
+        while True:
+            try:
+                index, pid, stats = self.stats_queue.get_nowait()
+            except queue.Empty:
+                return
+            if self.processes.get(index) and self.processes[index].pid == pid:
+                self.reports[index] = stats
+
+    def stats(self):
+        self.collect()
+        merged = merge_stats(list(self.reports.values())) if self.reports else {}
+        merged["workers"] = {"running": sum(p.is_alive() for p in self.processes.values()), "restarts": self.restarts}
+        return merged
+
+    def start(self):
+        print(f"Supervisor starting {self.workers} workers on {self.host}:{self.port}")
+        for index in range(self.workers):
+            self.spawn(index)
+        if self.metrics_server:
+            self.metrics_server.start()
+        last_report = time.monotonic()
+        try:
+            while True:
+                time.sleep(0.5)
+                for index, process in list(self.processes.items()):
+                    if not process.is_alive():
+                        print(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, restarting.")
+                        self.reports.pop(index, None)
+                        self.restarts += 1
+                        self.spawn(index)
+                if time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    stats = self.stats()
+                    games = stats.get("games", {})
+                    print(f"{stats['workers']['running']} workers, {games.get('active', 0)} active games, "
+                          f"{games.get('started', 0)} started, {stats['workers']['restarts']} restarts")
+        except KeyboardInterrupt:
+            print("Supervisor shutting down.")
+        finally:
+            if self.metrics_server:
+                self.metrics_server.stop()
+            for process in self.processes.values():
+                if process.is_alive():
+                    process.terminate()
+            for process in self.processes.values():
+                process.join(timeout=10)